@@ -0,0 +1,65 @@
+"""Throughput of many concurrent instrumented coroutines.
+
+Example usage:
+  python benchmarks/coroutines.py
+
+Runs thousands of asyncio tasks that each call an `async def` ptera function
+with their own tap, checks that every task only collected its own values,
+and compares against uninstrumented calls.
+"""
+
+import asyncio
+import time
+
+from ptera import ptera
+
+TASKS = 2_000
+STEPS = 10
+
+
+@ptera
+async def step(i, j):
+    await asyncio.sleep(0)
+    x = i * STEPS + j
+    return x
+
+
+@ptera
+async def job(i):
+    total = 0
+    for j in range(STEPS):
+        x = await step(i, j)
+        total = total + x
+    return total
+
+
+async def run_plain(i):
+    return await job(i)
+
+
+async def run_tapped(i):
+    total, xs = await job.using("step > x")(i)
+    assert xs.map("x") == [i * STEPS + j for j in range(STEPS)]
+    return total
+
+
+async def gather(fn):
+    return await asyncio.gather(*[fn(i) for i in range(TASKS)])
+
+
+def main():
+    t0 = time.perf_counter()
+    plain = asyncio.run(gather(run_plain))
+    t1 = time.perf_counter()
+    tapped = asyncio.run(gather(run_tapped))
+    t2 = time.perf_counter()
+    assert plain == tapped
+
+    n = TASKS * STEPS
+    print(f"{TASKS} tasks, {STEPS} awaits each")
+    print(f"no tap:   {n / (t1 - t0):10.0f} calls/s")
+    print(f"with tap: {n / (t2 - t1):10.0f} calls/s")
+
+
+if __name__ == "__main__":
+    main()
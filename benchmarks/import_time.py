@@ -0,0 +1,80 @@
+"""Time to import a module with many @ptera functions.
+
+Example usage:
+  python benchmarks/import_time.py
+
+Writes a module with a few hundred decorated functions to a temporary
+directory, then measures the time to import it, and the time to transform
+every function afterwards, as happens on their first call, without the
+on-disk cache of transformed code, then with a cold and a warm cache.
+"""
+
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+from ptera.selfless import SourceFile
+
+N = 300
+
+TEMPLATE = """
+@ptera
+def fn{i}(x, y=2):
+    # Scale factor
+    scale: float = 1.5
+    z = x * y + {i}
+    w = z * scale
+    return w
+"""
+
+
+def write_module(directory):
+    path = os.path.join(directory, "many_functions.py")
+    with open(path, "w") as f:
+        f.write("from ptera import ptera\n")
+        for i in range(N):
+            f.write(TEMPLATE.format(i=i))
+    return path
+
+
+def import_module(path):
+    spec = importlib.util.spec_from_file_location("many_functions", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def transform_all(module):
+    t0 = time.perf_counter()
+    for i in range(N):
+        getattr(module, f"fn{i}").state
+    return time.perf_counter() - t0
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_module(directory)
+        os.environ["PTERA_CACHE"] = "0"
+        t0 = time.perf_counter()
+        module = import_module(path)
+        t1 = time.perf_counter()
+        uncached = transform_all(module)
+
+        # Each import starts from a fresh SourceFile, like a new process
+        os.environ["PTERA_CACHE"] = "1"
+        sys.dont_write_bytecode = False
+        SourceFile._cache.clear()
+        cold = transform_all(import_module(path))
+        SourceFile._cache.clear()
+        warm = transform_all(import_module(path))
+
+    print(f"import {N} functions:     {(t1 - t0) * 1000:8.1f} ms")
+    print(f"transform all functions: {uncached * 1000:8.1f} ms")
+    print(f"  with a cold cache:     {cold * 1000:8.1f} ms")
+    print(f"  with a warm cache:     {warm * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
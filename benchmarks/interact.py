@@ -0,0 +1,88 @@
+"""Cost of a call and of an assignment in a @ptera function.
+
+Example usage:
+  python benchmarks/interact.py
+
+Compares plain Python functions with the same functions decorated with
+`@ptera`, called without any active pattern (fast path) and with a tap on an
+unrelated variable (slow path). The two functions differ only by their
+number of assignments, so the overhead per call is measured on the short
+one, and the overhead per assignment is the slope between the two.
+"""
+
+import timeit
+
+from ptera import ptera
+
+N = 50_000
+SHORT = 1
+LONG = 9
+
+
+def plain_short(x, y):
+    a = x + y
+    return a
+
+
+def plain_long(x, y):
+    a = x + y
+    b = a * x
+    c = b - y
+    d = c + a
+    e = d * 2
+    f = e - b
+    g = f + c
+    h = g * y
+    i = h - a
+    return i
+
+
+@ptera
+def short(x, y):
+    a = x + y
+    return a
+
+
+@ptera
+def long(x, y):
+    a = x + y
+    b = a * x
+    c = b - y
+    d = c + a
+    e = d * 2
+    f = e - b
+    g = f + c
+    h = g * y
+    i = h - a
+    return i
+
+
+def measure(fn):
+    return min(timeit.repeat(lambda: fn(1, 2), number=N, repeat=3)) / N
+
+
+def main():
+    base_short = measure(plain_short)
+    base_long = measure(plain_long)
+    print(f"plain:     {base_short * 1e9:8.0f} ns/call")
+    cases = [
+        ("fast path", short, long),
+        (
+            "tapped",
+            short.using("short > nothing"),
+            long.using("long > nothing"),
+        ),
+    ]
+    for name, fshort, flong in cases:
+        t_short = measure(fshort)
+        t_long = measure(flong)
+        per_call = t_short - base_short
+        per_assign = ((t_long - base_long) - per_call) / (LONG - SHORT)
+        print(
+            f"{name + ':':10} {per_call * 1e9:8.0f} ns/call overhead,"
+            f" {per_assign * 1e9:6.0f} ns/assignment overhead"
+        )
+
+
+if __name__ == "__main__":
+    main()
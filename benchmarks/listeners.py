@@ -0,0 +1,53 @@
+"""Throughput of listeners and Collector.map callbacks.
+
+Example usage:
+  python benchmarks/listeners.py
+
+Measures how many matches per second a listener registered with `overlay`
+processes, and how many entries per second `Collector.map(fn)` goes through.
+"""
+
+import time
+
+from ptera import overlay, ptera
+
+N = 20_000
+
+
+@ptera
+def inner(i):
+    x = i * 2
+    y = x + 1
+    return y
+
+
+@ptera
+def loop(n):
+    for i in range(n):
+        inner(i)
+
+
+def main():
+    count = 0
+
+    def listener(x, y):
+        nonlocal count
+        count += 1
+
+    t0 = time.perf_counter()
+    with overlay({"inner{!x, y}": {"listeners": listener}}):
+        loop(N)
+    t1 = time.perf_counter()
+    assert count == N
+
+    _, results = loop.using("inner{!x, y}")(N)
+    t2 = time.perf_counter()
+    list(results.map(lambda x, y: x + y))
+    t3 = time.perf_counter()
+
+    print(f"call with listener: {N / (t1 - t0):10.0f} matches/s")
+    print(f"Collector.map(fn):  {N / (t3 - t2):10.0f} entries/s")
+
+
+if __name__ == "__main__":
+    main()
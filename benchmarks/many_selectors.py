@@ -0,0 +1,46 @@
+"""Cost of many active selectors over a deep call tree.
+
+Example usage:
+  python benchmarks/selectors.py
+
+Calls a recursive @ptera function under hundreds of selectors. Only one of
+them matches the recursive function, the others target functions that are
+never called. The selectors are set up once, outside of the timed calls,
+either as a PatternCollection or compiled into an automaton.
+"""
+
+import timeit
+
+from ptera import overlay, ptera
+from ptera.core import Collector
+
+DEPTH = 50
+N = 20
+
+
+@ptera
+def descend(n):
+    if n == 0:
+        return 0
+    rval = descend(n - 1) + 1
+    return rval
+
+
+def main():
+    for nsel in [0, 10, 100, 500]:
+        selectors = ["descend > rval"]
+        selectors += [f"unrelated{i} > x" for i in range(nsel)]
+        for compiled in [False, True]:
+            collectors = [Collector(sel) for sel in selectors]
+            rules = [coll.rules() for coll in collectors]
+            with overlay(*rules, compiled=compiled):
+                t = timeit.timeit(lambda: descend(DEPTH), number=N) / N
+            kind = "compiled" if compiled else "indexed"
+            print(
+                f"{nsel:4} selectors ({kind}): {t * 1e3:8.2f} ms/call"
+                f" ({t / DEPTH * 1e6:.1f} us/frame)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Memory used per captured value.
+
+Example usage:
+  python benchmarks/memory.py
+
+Measures the memory retained by the results of a tap, divided by the number
+of captured values, when each value is a separate match (`!x`) and when all
+values accumulate in a single match (`x`).
+"""
+
+import tracemalloc
+
+from ptera import ptera
+
+N = 100_000
+
+
+@ptera
+def inner(i):
+    x = i * 2
+    return x
+
+
+@ptera
+def loop(n):
+    for i in range(n):
+        inner(i)
+
+
+def measure(selector):
+    fn = loop.using(selector)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    _, results = fn(N)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(results.map_all("x")) in (1, N)
+    return (after - before) / N, (peak - before) / N
+
+
+def main():
+    for selector in ["inner{!x}", "loop{inner{x}}"]:
+        retained, peak = measure(selector)
+        print(
+            f"{selector:15} {retained:8.1f} bytes/value retained,"
+            f" {peak:8.1f} bytes/value peak"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Scaling of a shared Storage across threads.
+
+Example usage:
+  python benchmarks/storage_threads.py
+
+Runs the same instrumented function from 1, 2, 4 and 8 threads that share
+one ConcurrentStorage, with an initializer per key and an updater, and
+reports the total throughput for each thread count.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ptera import cat, ptera
+from ptera.storage import ConcurrentStorage, initializer, updater
+
+CALLS = 400
+KEYS = 64
+
+
+@ptera
+def layer(x):
+    weight: cat.Weight
+    return weight * x  # noqa: F821
+
+
+@ptera
+def model(x):
+    for i in range(KEYS):
+        x = layer[i](x) % 1000
+    return x
+
+
+class Weights(ConcurrentStorage):
+
+    pattern = "layer{#key, !weight:Weight}"
+    default_target = "weight"
+
+    @initializer
+    def init_weight(self):
+        return 1
+
+    @updater
+    def update_weight(self, weight):
+        return weight + 1
+
+
+def run(nthreads):
+    fn = model.using(Weights())
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        list(executor.map(fn, range(CALLS)))
+    return CALLS * KEYS / (time.perf_counter() - t0)
+
+
+def main():
+    for nthreads in (1, 2, 4, 8):
+        print(f"{nthreads} threads: {run(nthreads):10.0f} layer calls/s")
+
+
+if __name__ == "__main__":
+    main()
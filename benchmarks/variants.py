@@ -0,0 +1,40 @@
+"""Cost of creating configured variants of a @ptera function.
+
+Example usage:
+  python benchmarks/variants.py
+
+Measures `new`, `tweak` and `using` on a function with many state variables,
+which copy the state, and a call of one of the resulting variants.
+"""
+
+import timeit
+
+from ptera import ptera
+
+N = 20_000
+
+
+@ptera
+def configured(x, a=1, b=2, c=3, d=4, e=5, f=6, g=7, h=8):
+    total = a + b + c + d + e + f + g + h
+    return x * total
+
+
+def measure(fn):
+    return timeit.timeit(fn, number=N) / N
+
+
+def main():
+    variant = configured.new(a=10)
+    cases = [
+        ("new", lambda: configured.new(a=10)),
+        ("tweak", lambda: configured.tweak({"a": 10})),
+        ("using", lambda: configured.using("configured > a")),
+        ("call", lambda: variant(1)),
+    ]
+    for name, fn in cases:
+        print(f"{name + ':':7} {measure(fn) * 1e9:8.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,17 @@ from .core import (
     to_pattern,
 )
 from .recur import Recurrence
-from .selfless import ConflictError, Override, default, override, transform
+from .selfless import (
+    ConflictError,
+    Override,
+    PreFunction,
+    default,
+    override,
+    transform,
+)
 from .storage import Storage, initializer, updater, valuer
 from .tools import Configurator, auto_cli, catalogue
+from .version import version as __version__
 
 
 class PteraDecorator:
@@ -20,8 +28,7 @@ class PteraDecorator:
         return self({**self.kwargs, "defaults": defaults})
 
     def __call__(self, fn):
-        new_fn, state = transform(fn, interact=interact)
-        fn = PteraFunction(new_fn, state)
+        fn = PteraFunction(PreFunction(fn, interact=interact), None)
         if "defaults" in self.kwargs:
             fn = fn.new(**self.kwargs)
         return fn
@@ -0,0 +1,190 @@
+"""Selectors compiled into a lazily constructed deterministic automaton.
+
+The matching state of a call path is the ordered list of pattern nodes that
+are active at that point. That list only depends on the names of the
+functions in the path, so it is interned as a `State` and the effect of
+entering a function, which involves matching, forking accumulators and
+queuing children, is computed once per (state, function name) and stored as
+a `Transition`. After warmup, entering a frame is a dictionary lookup
+followed by the execution of the matches in the transition, regardless of
+how many selectors are active.
+"""
+
+from functools import lru_cache
+
+
+class State:
+    """Set of active pattern nodes.
+
+    Attributes:
+        automaton: The automaton this state belongs to.
+        nested: Tuple of (pattern, is_template) that stay active in nested
+            calls.
+        immediate: Tuple of (pattern, is_template) that only apply to the
+            next call.
+        transitions: Map from function name to Transition.
+    """
+
+    __slots__ = ("automaton", "nested", "immediate", "transitions")
+
+    def __init__(self, automaton, nested, immediate):
+        self.automaton = automaton
+        self.nested = nested
+        self.immediate = immediate
+        self.transitions = {}
+
+    def transition(self, fname):
+        rval = self.transitions.get(fname, None)
+        if rval is None:
+            rval = self.automaton.compute_transition(self, fname)
+            self.transitions[fname] = rval
+        return rval
+
+
+class Transition:
+    """Effect of entering a function from a given state.
+
+    Attributes:
+        target: The next State, or None if no pattern can match anymore.
+        matches: List of (source, focus, captures, close_at_exit). Each match
+            forks an accumulator. A source >= 0 is an index into the
+            accumulators of the current state (nested, then immediate) and a
+            source < 0 refers to the accumulator forked by match -source - 1.
+        new_nested: Indexes of the matches whose accumulators are associated
+            to the nested patterns that the target state adds.
+        new_immediate: Same as new_nested, for the immediate patterns.
+    """
+
+    __slots__ = ("target", "matches", "new_nested", "new_immediate")
+
+    def __init__(self, target, matches, new_nested, new_immediate):
+        self.target = target
+        self.matches = matches
+        self.new_nested = new_nested
+        self.new_immediate = new_immediate
+
+
+class Automaton:
+    def __init__(self):
+        self.states = {}
+
+    def state(self, nested, immediate):
+        key = (nested, immediate)
+        if key not in self.states:
+            self.states[key] = State(self, nested, immediate)
+        return self.states[key]
+
+    def compute_transition(self, state, fname):
+        current = [
+            (pattern, is_template, i)
+            for i, (pattern, is_template) in enumerate(
+                state.nested + state.immediate
+            )
+        ]
+        to_process = [
+            entry for entry in current if entry[0].element.name in (None, fname)
+        ]
+        to_process.reverse()
+
+        matches = []
+        new_nested = []
+        new_immediate = []
+        while to_process:
+            pattern, is_template, source = to_process.pop()
+            ename = pattern.element.name
+            if ename is not None and ename != fname:
+                continue
+            matches.append(
+                (
+                    source,
+                    pattern.focus or is_template,
+                    pattern.captures,
+                    is_template,
+                )
+            )
+            ref = -len(matches)
+            for child in pattern.children:
+                if child.immediate:
+                    new_immediate.append((child, ref))
+                else:
+                    new_nested.append((child, ref))
+                    if child.collapse:
+                        to_process.append((child, False, ref))
+
+        if not matches and not state.immediate:
+            return Transition(state, [], [], [])
+
+        nested = state.nested + tuple((p, False) for p, _ in new_nested)
+        immediate = tuple((p, False) for p, _ in new_immediate)
+        if not nested and not immediate:
+            target = None
+        else:
+            target = self.state(nested, immediate)
+        return Transition(
+            target=target,
+            matches=matches,
+            new_nested=[-ref - 1 for _, ref in new_nested],
+            new_immediate=[-ref - 1 for _, ref in new_immediate],
+        )
+
+
+@lru_cache(maxsize=128)
+def _initial_state(nested, immediate):
+    return Automaton().state(nested, immediate)
+
+
+class CompiledPatternCollection:
+    """PatternCollection backed by an Automaton.
+
+    Collections built from structurally identical patterns share the same
+    automaton, so the transitions computed in one call are reused in the
+    next.
+    """
+
+    def __init__(self, patterns=None, state=None, accs=None):
+        if patterns is not None:
+            assert state is None and accs is None
+            patterns = list(patterns)
+            nested = [(p, acc) for p, acc in patterns if not p.immediate]
+            immediate = [(p, acc) for p, acc in patterns if p.immediate]
+            state = _initial_state(
+                tuple((p, acc.template) for p, acc in nested),
+                tuple((p, acc.template) for p, acc in immediate),
+            )
+            accs = [acc for _, acc in nested + immediate]
+        self.state = state
+        self.accs = accs
+
+    @property
+    def patterns(self):
+        nodes = self.state.nested + self.state.immediate
+        return [(p, acc) for (p, _), acc in zip(nodes, self.accs)]
+
+    def merge(self, other):
+        return CompiledPatternCollection(self.patterns + other.patterns)
+
+    def proceed(self, fname, frame):
+        tr = self.state.transition(fname)
+        accs = self.accs
+        forks = []
+        for source, focus, captures, close_at_exit in tr.matches:
+            acc = accs[source] if source >= 0 else forks[-source - 1]
+            acc = acc.fork(focus=focus)
+            frame.register(acc, captures, close_at_exit=close_at_exit)
+            forks.append(acc)
+
+        if tr.target is None:
+            return None
+        elif not forks and tr.target is self.state:
+            # The target may be the same state even when accumulators were
+            # forked, e.g. in recursive calls, so the forks must be checked
+            return self
+        nnested = len(self.state.nested)
+        new_accs = accs[:nnested]
+        new_accs += [forks[i] for i in tr.new_nested]
+        new_accs += [forks[i] for i in tr.new_immediate]
+        return CompiledPatternCollection(state=tr.target, accs=new_accs)
+
+    def show(self):
+        for pattern, acc in self.patterns:
+            print(pattern.encode(), "\t", acc)
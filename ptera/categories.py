@@ -69,19 +69,19 @@ def match_category(to_match, category, value=ABSENT):
     if isinstance(to_match, str):
         to_match = category_registry[to_match]
 
-    if category is None:
-        cats = set()
-    elif isinstance(category, CategorySet):
-        cats = category.members
-    else:
-        cats = {category}
-
     rval = False
     if to_match is None:
         rval = True
     elif isinstance(to_match, type) and isinstance(value, to_match):
         rval = True
 
+    if category is None:
+        return rval
+    elif isinstance(category, CategorySet):
+        cats = category.members
+    else:
+        cats = (category,)
+
     for cat in cats:
         if isinstance(cat, type):
             if value is ABSENT:
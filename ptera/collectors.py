@@ -0,0 +1,707 @@
+"""Alternative collectors for taps."""
+
+import inspect
+import math
+import random
+from abc import ABC, abstractmethod
+from array import array
+from collections import deque
+
+from .core import Capture, Collector, Tap
+from .selector import to_pattern
+from .utils import get_binder
+
+_typecodes = {int: "q", float: "d"}
+
+
+class Column:
+    """Values acquired for one capture, across all matches.
+
+    Ints and floats are stored in a typed `array.array` as long as all values
+    have the same type, which can be wrapped without a copy by
+    `numpy.asarray` or `memoryview`. Other values are stored in a list. If a
+    match acquires more than one value for the capture, every entry becomes
+    a list of values.
+    """
+
+    __slots__ = ("data", "ragged")
+
+    def __init__(self):
+        self.data = None
+        self.ragged = False
+
+    def _append(self, value):
+        data = self.data
+        if data is None:
+            code = _typecodes.get(type(value), None)
+            data = self.data = array(code) if code else []
+        elif type(data) is array:
+            if _typecodes.get(type(value), None) == data.typecode:
+                try:
+                    data.append(value)
+                    return
+                except OverflowError:
+                    pass
+            data = self.data = list(data)
+        data.append(value)
+
+    def append(self, cap):
+        if not self.ragged:
+            try:
+                self._append(cap.value)
+                return
+            except ValueError:
+                self.data = [[v] for v in self.data or ()]
+                self.ragged = True
+        self.data.append(list(cap.values))
+
+    def single(self):
+        """Return one value per match, raising if a match has several."""
+        if self.ragged:
+            for entry in self.data:
+                if len(entry) != 1:
+                    raise ValueError("Multiple values stored for capture")
+            return [entry[0] for entry in self.data]
+        return self.data if self.data is not None else []
+
+    def all(self):
+        """Return the list of values of each match."""
+        if self.ragged:
+            return self.data
+        return [[v] for v in self.data or ()]
+
+
+class ColumnarCollector(Collector):
+    """Collector that stores captured values in one column per capture.
+
+    `map` with capture names returns the columns themselves, without
+    building a dict per match. Iterating over the collector or calling
+    `map_full` reconstructs the Capture objects.
+    """
+
+    def __init__(self, pattern, finalize=None):
+        self.pattern = to_pattern(pattern)
+        self.finalizer = finalize
+        self.length = 0
+        self.columns = {}
+        # Variable names for captures that do not fix the name, like `$x`
+        self.varnames = {}
+        self.elements = {}
+
+        def listener(**kwargs):
+            for name, cap in kwargs.items():
+                column = self.columns.get(name, None)
+                if column is None:
+                    column = self._new_column(name, cap)
+                column.append(cap)
+                if cap.element.name is None:
+                    self.varnames[name].append(cap.names)
+            self.length += 1
+
+        listener._ptera_argspec = None, set(self.pattern.all_captures())
+        self._listener = listener
+
+    def _new_column(self, name, cap):
+        column = self.columns[name] = Column()
+        self.elements[name] = cap.element
+        if cap.element.name is None:
+            self.varnames[name] = []
+        return column
+
+    def _captures(self, name):
+        element = self.elements[name]
+        names = self.varnames.get(name, None)
+        for i, values in enumerate(self.columns[name].all()):
+            cap = Capture(element)
+            varnames = (
+                [element.name] * len(values) if names is None else names[i]
+            )
+            for varname, value in zip(varnames, values):
+                cap.acquire(varname, value)
+            yield cap
+
+    @property
+    def data(self):
+        """List of dicts of Captures, one per match, built on demand."""
+        columns = {name: self._captures(name) for name in self.columns}
+        return [
+            {name: next(caps) for name, caps in columns.items()}
+            for _ in range(self.length)
+        ]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return self.length
+
+    def merge(self, other):
+        """Append the columns of another ColumnarCollector."""
+        for name in other.columns:
+            column = self.columns.get(name, None)
+            if column is None:
+                column = self._new_column(name, Capture(other.elements[name]))
+            for cap in other._captures(name):
+                column.append(cap)
+                if name in self.varnames:
+                    self.varnames[name].append(cap.names)
+        self.length += other.length
+        return self
+
+    def column(self, name, multi=False):
+        """Return the values of the capture called name.
+
+        Arguments:
+            name: The name of the capture.
+            multi: If False, return one value per match, otherwise return
+                the list of values for each match.
+        """
+        column = self.columns.get(name, None)
+        if column is None:
+            return []
+        return column.all() if multi else column.single()
+
+    def _map_columns(self, args, multi):
+        if not args:
+            columns = {name: self.column(name, multi) for name in self.columns}
+            return [
+                {name: col[i] for name, col in columns.items()}
+                for i in range(self.length)
+            ]
+        elif isinstance(args[0], str):
+            assert all(isinstance(arg, str) for arg in args)
+            results = [self.column(arg, multi) for arg in args]
+            if len(args) == 1:
+                return results[0]
+            else:
+                return list(zip(*results))
+        else:
+            assert len(args) == 1
+            (fn,) = args
+            binder = get_binder(fn)
+            names = [
+                name
+                for name in self.columns
+                if binder.varkw or name in binder.names
+            ]
+            columns = [self.column(name, multi) for name in names]
+            return [fn(**dict(zip(names, row))) for row in zip(*columns)]
+
+    def map(self, *args):
+        return self._map_columns(args, multi=False)
+
+    def map_all(self, *args):
+        return self._map_columns(args, multi=True)
+
+    def map_full(self, *args):
+        # data is rebuilt on each access, so it is wrapped in a plain
+        # Collector rather than cached in views
+        full = Collector(self.pattern)
+        full.data = self.data
+        return full.map_full(*args)
+
+
+class ColumnarTap(Tap):
+    """Tap that collects its results in a ColumnarCollector."""
+
+    def instantiate(self):
+        return ColumnarCollector(self.selector, self.finalize)
+
+
+class StreamCollector:
+    """Collector that passes each match to a consumer without storing it.
+
+    Matches are delivered as soon as the accumulator for the selector's
+    outermost function closes, so a selector such as `step > loss` streams
+    one loss per call to `step`.
+
+    Arguments:
+        pattern: The selector.
+        consumer: Where to send the matches. It can be a generator, which
+            receives a dict for each match through `send`, a generator
+            function, which is called to create such a generator that is
+            closed by `finalize`, an object with a `put` method such as a
+            bounded `queue.Queue`, which receives a dict for each match, or
+            a function, which is called with the captures as keyword
+            arguments.
+        finalize: Function to call on this collector at the end of the call.
+        full: Pass Capture objects rather than their values.
+    """
+
+    def __init__(self, pattern, consumer, finalize=None, full=False):
+        self.pattern = to_pattern(pattern)
+        self.finalizer = finalize
+        self.full = full
+        self.count = 0
+        self._close = False
+
+        if inspect.isgeneratorfunction(consumer):
+            consumer = consumer()
+            self._close = True
+        if inspect.isgenerator(consumer):
+            if inspect.getgeneratorstate(consumer) == inspect.GEN_CREATED:
+                next(consumer)
+            push = consumer.send
+        elif hasattr(consumer, "put"):
+            push = consumer.put
+        else:
+            binder = get_binder(consumer)
+
+            def push(captures):
+                return consumer(**binder.bind(captures))
+
+        self.consumer = consumer
+        self._push = push
+
+        def listener(**kwargs):
+            if not self.full:
+                kwargs = {name: cap.value for name, cap in kwargs.items()}
+            self._push(kwargs)
+            self.count += 1
+
+        listener._ptera_argspec = None, set(self.pattern.all_captures())
+        self._listener = listener
+
+    def rules(self):
+        return {self.pattern: {"listeners": [self._listener]}}
+
+    def finalize(self):
+        if self._close:
+            self.consumer.close()
+        if self.finalizer:
+            return self.finalizer(self)
+        else:
+            return self
+
+    def __str__(self):
+        return f"StreamCollector({self.pattern}, count={self.count})"
+
+    __repr__ = __str__
+
+
+class StreamTap:
+    """Tap that streams its matches to a consumer.
+
+    See StreamCollector for the meaning of the arguments. If consumer is a
+    generator function, a new generator is created for each call.
+    """
+
+    hasoutput = True
+
+    def __init__(self, selector, consumer, finalize=None, full=False):
+        self.selector = selector
+        self.consumer = consumer
+        self.finalize = finalize
+        self.full = full
+
+    def hook(self, finalize):
+        self.finalize = finalize
+        return self
+
+    def instantiate(self):
+        return StreamCollector(
+            self.selector,
+            self.consumer,
+            finalize=self.finalize,
+            full=self.full,
+        )
+
+
+class SamplingCollector(Collector, ABC):
+    """Collector that only keeps some of the matches.
+
+    Subclasses implement `accepts(index)`, which decides from the index of a
+    match among all the matches whether it may be kept, and `offer(index,
+    captures)`, which is called with the matches that are accepted and may
+    store them in `data`. `accepts` is checked before the listener is called
+    with the captures, so a skipped match does not go through the listener.
+    """
+
+    def __init__(self, pattern, finalize=None):
+        super().__init__(pattern, finalize)
+        self.seen = 0
+        # Index of the match that was last accepted, to offer next
+        self._accepted = None
+
+        def accept():
+            index = self.seen
+            self.seen = index + 1
+            if self.accepts(index):
+                self._accepted = index
+                return True
+            return False
+
+        def listener(**kwargs):
+            index = self._accepted
+            self._accepted = None
+            if index is None:
+                # The listener was called without accept, e.g. by a wrapper
+                if not accept():
+                    return
+                index = self._accepted
+                self._accepted = None
+            self.offer(index, kwargs)
+
+        listener._ptera_argspec = None, set(self.pattern.all_captures())
+        listener._ptera_accept = accept
+        self._listener = listener
+
+    def accepts(self, index):
+        """Return whether the match at the given index may be kept."""
+        return True
+
+    @abstractmethod
+    def offer(self, index, captures):
+        """Store the match at the given index, or not."""
+
+
+class StridedCollector(SamplingCollector):
+    """Keep every stride-th match, starting with the match at offset."""
+
+    def __init__(self, pattern, stride, offset=0, finalize=None):
+        super().__init__(pattern, finalize)
+        self.stride = stride
+        self.next = offset
+
+    def accepts(self, index):
+        return index == self.next
+
+    def offer(self, index, captures):
+        self.data.append(captures)
+        self.next += self.stride
+
+
+class FirstCollector(SamplingCollector):
+    """Keep the first k matches."""
+
+    def __init__(self, pattern, k, finalize=None):
+        super().__init__(pattern, finalize)
+        self.k = k
+
+    def accepts(self, index):
+        return index < self.k
+
+    def offer(self, index, captures):
+        self.data.append(captures)
+
+
+class LastCollector(SamplingCollector):
+    """Keep the last k matches."""
+
+    def __init__(self, pattern, k, finalize=None):
+        super().__init__(pattern, finalize)
+        self.data = deque(maxlen=k)
+
+    def offer(self, index, captures):
+        self.data.append(captures)
+
+    def finalize(self):
+        self.data = list(self.data)
+        return super().finalize()
+
+
+class ReservoirCollector(SamplingCollector):
+    """Keep a uniform sample of k matches, in the order they occurred.
+
+    This uses Li's Algorithm L, which computes how many matches to skip
+    before the next one to keep, so a skipped match only costs a
+    comparison.
+    """
+
+    def __init__(self, pattern, k, seed=None, finalize=None):
+        super().__init__(pattern, finalize)
+        self.k = k
+        self.random = random.Random(seed)
+        self.indices = []
+        self.w = 1.0
+        self.next = k
+
+    def _advance(self, index):
+        # 1 - random() is in (0, 1], which is safe to pass to log
+        rnd = self.random.random
+        self.w *= math.exp(math.log(1.0 - rnd()) / self.k)
+        skip = int(math.log(1.0 - rnd()) / math.log1p(-self.w))
+        self.next = index + skip + 1
+
+    def accepts(self, index):
+        return index < self.k or index == self.next
+
+    def offer(self, index, captures):
+        if index < self.k:
+            self.data.append(captures)
+            self.indices.append(index)
+            if index == self.k - 1:
+                self._advance(index)
+        else:
+            j = self.random.randrange(self.k)
+            self.data[j] = captures
+            self.indices[j] = index
+            self._advance(index)
+
+    def finalize(self):
+        order = sorted(range(len(self.data)), key=self.indices.__getitem__)
+        self.data = [self.data[i] for i in order]
+        self.indices = [self.indices[i] for i in order]
+        return super().finalize()
+
+
+class SampleTap(Tap):
+    """Tap that keeps a sample of its matches.
+
+    Exactly one of the sampling arguments must be given.
+
+    Arguments:
+        selector: The selector.
+        finalize: Function to call on the collector at the end of the call.
+        every: Keep one match every `every` matches.
+        reservoir: Keep a uniform sample of `reservoir` matches.
+        first: Keep the first `first` matches.
+        last: Keep the last `last` matches.
+        seed: Seed for the reservoir's random number generator.
+    """
+
+    def __init__(
+        self,
+        selector,
+        finalize=None,
+        *,
+        every=None,
+        reservoir=None,
+        first=None,
+        last=None,
+        seed=None,
+    ):
+        super().__init__(selector, finalize)
+        options = dict(every=every, reservoir=reservoir, first=first, last=last)
+        options = {k: v for k, v in options.items() if v is not None}
+        if len(options) != 1:
+            raise TypeError(
+                "SampleTap requires exactly one of every, reservoir,"
+                " first or last"
+            )
+        ((self.mode, self.k),) = options.items()
+        self.seed = seed
+
+    def instantiate(self):
+        if self.mode == "every":
+            return StridedCollector(
+                self.selector, self.k, finalize=self.finalize
+            )
+        elif self.mode == "reservoir":
+            return ReservoirCollector(
+                self.selector, self.k, seed=self.seed, finalize=self.finalize
+            )
+        elif self.mode == "first":
+            return FirstCollector(self.selector, self.k, finalize=self.finalize)
+        else:
+            return LastCollector(self.selector, self.k, finalize=self.finalize)
+
+
+def _is_array(value):
+    return hasattr(value, "shape") and hasattr(value, "dtype")
+
+
+class RunningStats:
+    """Statistics folded one value at a time, in constant memory.
+
+    The mean and variance use Welford's algorithm. Values can be numbers or
+    NumPy arrays, in which case the statistics are elementwise.
+
+    Arguments:
+        bins: A (low, high, nbins) tuple to also compute a histogram with
+            nbins equal bins between low and high, or None. The counts of
+            values below low and above high are kept in `underflow` and
+            `overflow`. For arrays, the histogram counts every element.
+    """
+
+    def __init__(self, bins=None):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.bins = bins
+        if bins is not None:
+            _, _, nbins = bins
+            self.histogram = [0] * nbins
+            self.underflow = 0
+            self.overflow = 0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (value - self.mean)
+        if _is_array(value):
+            import numpy
+
+            if self.min is None:
+                self.min = numpy.array(value)
+                self.max = numpy.array(value)
+            else:
+                numpy.minimum(self.min, value, out=self.min)
+                numpy.maximum(self.max, value, out=self.max)
+        else:
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+        if self.bins is not None:
+            self._add_to_histogram(value)
+
+    def _add_to_histogram(self, value):
+        low, high, nbins = self.bins
+        if _is_array(value):
+            import numpy
+
+            flat = numpy.ravel(value)
+            counts, _ = numpy.histogram(flat, bins=nbins, range=(low, high))
+            for i, c in enumerate(counts.tolist()):
+                self.histogram[i] += c
+            self.underflow += int((flat < low).sum())
+            self.overflow += int((flat > high).sum())
+        elif value < low:
+            self.underflow += 1
+        elif value > high:
+            self.overflow += 1
+        else:
+            i = int((value - low) / (high - low) * nbins)
+            self.histogram[min(i, nbins - 1)] += 1
+
+    def merge(self, other):
+        """Add the statistics of other, which must use the same bins."""
+        if other.count == 0:
+            return self
+        elif self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+        else:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean = self.mean + delta * other.count / count
+            self.m2 = (
+                self.m2
+                + other.m2
+                + delta * delta * self.count * other.count / count
+            )
+            self.count = count
+            if _is_array(self.min):
+                import numpy
+
+                self.min = numpy.minimum(self.min, other.min)
+                self.max = numpy.maximum(self.max, other.max)
+            else:
+                self.min = min(self.min, other.min)
+                self.max = max(self.max, other.max)
+        if self.bins is not None:
+            assert self.bins == other.bins
+            self.histogram = [
+                a + b for a, b in zip(self.histogram, other.histogram)
+            ]
+            self.underflow += other.underflow
+            self.overflow += other.overflow
+        return self
+
+    @property
+    def var(self):
+        """Population variance."""
+        if self.count == 0:
+            raise ValueError("No values to compute the variance of")
+        return self.m2 / self.count
+
+    @property
+    def std(self):
+        return self.var ** 0.5
+
+    def __str__(self):
+        return (
+            f"RunningStats(count={self.count}, mean={self.mean},"
+            f" min={self.min}, max={self.max})"
+        )
+
+    __repr__ = __str__
+
+
+class AggregateCollector:
+    """Collector that folds each match into running statistics.
+
+    The statistics for each capture are in a RunningStats object that can
+    be retrieved with `collector[name]`. Every value of a capture is folded,
+    including when a match accumulates several values for it.
+
+    Arguments:
+        pattern: The selector.
+        finalize: Function to call on this collector at the end of the call.
+        bins: Histogram bins for RunningStats.
+    """
+
+    def __init__(self, pattern, finalize=None, bins=None):
+        self.pattern = to_pattern(pattern)
+        self.finalizer = finalize
+        self.matches = 0
+        self.stats = {
+            name: RunningStats(bins=bins)
+            for name in self.pattern.all_captures()
+        }
+
+        def listener(**kwargs):
+            self.matches += 1
+            for name, cap in kwargs.items():
+                stats = self.stats[name]
+                for value in cap.values:
+                    stats.add(value)
+
+        listener._ptera_argspec = None, set(self.stats)
+        self._listener = listener
+
+    def __getitem__(self, name):
+        return self.stats[name]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_listener"]
+        del state["finalizer"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.finalizer = None
+
+    def map(self, *args):
+        raise TypeError(
+            "AggregateCollector only keeps statistics, use collector[name]"
+        )
+
+    map_all = map_full = map
+
+    def merge(self, other):
+        """Combine the statistics of another AggregateCollector."""
+        self.matches += other.matches
+        for name, stats in other.stats.items():
+            self.stats[name].merge(stats)
+        return self
+
+    def rules(self):
+        return {self.pattern: {"listeners": [self._listener]}}
+
+    def finalize(self):
+        if self.finalizer:
+            return self.finalizer(self)
+        else:
+            return self
+
+
+class AggregateTap(Tap):
+    """Tap that computes running statistics of its matches.
+
+    See AggregateCollector for the meaning of the arguments.
+    """
+
+    def __init__(self, selector, finalize=None, bins=None):
+        super().__init__(selector, finalize)
+        self.bins = bins
+
+    def instantiate(self):
+        return AggregateCollector(
+            self.selector, finalize=self.finalize, bins=self.bins
+        )
@@ -1,15 +1,29 @@
+import contextvars
 import functools
+import importlib
 import inspect
+import pickle
 from collections import defaultdict
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from contextvars import ContextVar
-from copy import copy
 from itertools import chain, count
+from operator import attrgetter
 
+from .automaton import CompiledPatternCollection
 from .categories import match_category
 from .selector import to_pattern
-from .selfless import Selfless, choose, override
-from .utils import ABSENT, ACTIVE, COMPLETE, FAILED, call_with_captures, setvar
+from .selfless import Override, PreFunction, Selfless, choose, override
+from .utils import (
+    ABSENT,
+    ACTIVE,
+    COMPLETE,
+    FAILED,
+    call_with_captures,
+    setvar,
+    weak_cache,
+)
 
 _cnt = count()
 
@@ -51,39 +65,81 @@ class Frame:
             raise NameError(f"Cannot get value for variable `{varname}`")
         return rval
 
+    def deliver(self):
+        for acc in self.to_close:
+            acc.deliver()
+
     def exit(self):
         for acc in self.to_close:
             acc.close()
 
 
+def _copy_list(x):
+    return list(x) if isinstance(x, list) else x
+
+
 class Capture:
+    """Names and values acquired for an element of a selector.
+
+    The common case of a single name and value is stored inline, and lists
+    are only allocated when a second entry is acquired. The ``_names`` and
+    ``_values`` fields are ABSENT when empty, None when there is exactly one
+    entry (stored in ``_name`` or ``_value``), and a list otherwise.
+    """
+
+    __slots__ = ("element", "capture", "_name", "_names", "_value", "_values")
+
     def __init__(self, element):
         self.element = element
         self.capture = element.capture
-        self.names = []
-        self.values = []
+        self._name = None
+        self._names = ABSENT
+        self._value = None
+        self._values = ABSENT
+
+    @property
+    def names(self):
+        if self._names is ABSENT:
+            return []
+        elif self._names is None:
+            return [self._name]
+        else:
+            return self._names
+
+    @property
+    def values(self):
+        if self._values is ABSENT:
+            return []
+        elif self._values is None:
+            return [self._value]
+        else:
+            return self._values
 
     @property
     def name(self):
         if self.element.name is not None:
             return self.element.name
-        if len(self.names) == 0:
+        if self._names is None:
+            return self._name
+        if self._names is ABSENT:
             raise ValueError(f"No name for capture `{self.capture}`")
-        if len(self.names) > 1:
+        if len(self._names) > 1:
             raise ValueError(
                 f"Multiple names stored for capture `{self.capture}`"
             )
-        return self.names[0]
+        return self._names[0]
 
     @property
     def value(self):
-        if len(self.values) == 0:
+        if self._values is None:
+            return self._value
+        if self._values is ABSENT:
             raise ValueError(f"No value for capture `{self.capture}`")
-        if len(self.values) > 1:
+        if len(self._values) > 1:
             raise ValueError(
                 f"Multiple values stored for capture `{self.capture}`"
             )
-        return self.values[0]
+        return self._values[0]
 
     def nomatch(self):
         return None if self.element.name is None else False
@@ -98,10 +154,55 @@ class Capture:
         else:
             return True
 
+    def empty(self):
+        return self._names is ABSENT and self._values is ABSENT
+
+    def add_name(self, varname):
+        if self._names is ABSENT:
+            self._name = varname
+            self._names = None
+        elif self._names is None:
+            self._names = [self._name, varname]
+            self._name = None
+        else:
+            self._names.append(varname)
+
+    def pop_name(self):
+        if self._names is None:
+            self._name = None
+            self._names = ABSENT
+        else:
+            self._names.pop()
+
+    def add_value(self, value):
+        if self._values is ABSENT:
+            self._value = value
+            self._values = None
+        elif self._values is None:
+            self._values = [self._value, value]
+            self._value = None
+        else:
+            self._values.append(value)
+
     def acquire(self, varname, value):
         assert varname is not None
-        self.names.append(varname)
-        self.values.append(value)
+        self.add_name(varname)
+        self.add_value(value)
+
+    def snapshot(self):
+        """Return a copy of this Capture that will not see new entries."""
+        rval = Capture(self.element)
+        rval._name = self._name
+        rval._value = self._value
+        rval._names = _copy_list(self._names)
+        rval._values = _copy_list(self._values)
+        return rval
+
+    def extend(self, other):
+        for name in other.names:
+            self.add_name(name)
+        for value in other.values:
+            self.add_value(value)
 
     def __str__(self):
         return f"Capture({self.element}, {self.names}, {self.values})"
@@ -110,6 +211,21 @@ class Capture:
 
 
 class Accumulator:
+    __slots__ = (
+        "id",
+        "names",
+        "pattern",
+        "parent",
+        "children",
+        "rules",
+        "captures",
+        "status",
+        "template",
+        "focus",
+        "_env",
+        "_env_parent",
+    )
+
     def __init__(
         self,
         names,
@@ -120,17 +236,26 @@ class Accumulator:
         focus=True,
     ):
         self.id = next(_cnt)
-        self.names = set(names)
+        # Forks share the same frozenset of names
+        self.names = frozenset(names)
         self.pattern = pattern
         self.parent = parent
-        self.children = []
+        # Allocated on the first fork
+        self.children = None
         self.rules = rules or defaultdict(list)
         self.captures = {}
         self.status = ACTIVE
         self.template = template
         self.focus = focus
-        if self.parent is not None:
-            self.parent.children.append(self)
+        # Cache for build(), along with the parent's environment it was
+        # built from
+        self._env = None
+        self._env_parent = None
+        if parent is not None:
+            if parent.children is None:
+                parent.children = [self]
+            else:
+                parent.children.append(self)
 
     def getcap(self, element):
         if element.capture not in self.captures:
@@ -165,70 +290,111 @@ class Accumulator:
         if self.status is FAILED:
             return
         cap = self.getcap(element)
+        if cap.empty():
+            self._env = None
         cap.acquire(varname, value)
 
     def varget(self, element, varname, category, _):
         if not element.focus or self.status is FAILED:
             return ABSENT
         cap = self.getcap(element)
-        cap.names.append(varname)
+        if cap.empty():
+            self._env = None
+        cap.add_name(varname)
         rval = self.run("value", may_fail=False)
         if rval is ABSENT:
-            cap.names.pop()
+            cap.pop_name()
+            if cap.empty():
+                self._env = None
         else:
-            cap.values.append(rval)
+            cap.add_value(rval)
         return rval
 
     def build(self):
-        rval = {}
-        curr = self
-        while curr:
-            rval.update(
-                {
-                    name: cap
-                    for name, cap in curr.captures.items()
-                    if (cap.values or cap.names) and name is not None
-                }
-            )
-            curr = curr.parent
+        """Return a dict of the non-empty captures of self and its parents.
+
+        The result is cached and must not be modified. It is rebuilt when a
+        capture of this accumulator becomes empty or non-empty, or when the
+        parent's environment is rebuilt.
+        """
+        penv = None if self.parent is None else self.parent.build()
+        if self._env is not None and self._env_parent is penv:
+            return self._env
+        # A parent's capture takes precedence over a capture of the same
+        # name in self
+        rval = {
+            name: cap
+            for name, cap in self.captures.items()
+            if name is not None and not cap.empty()
+        }
+        if penv is not None:
+            rval.update(penv)
+        self._env = rval
+        self._env_parent = penv
         return rval
 
     def run(self, rulename, may_fail):
         if self.status is FAILED:
             return FAILED
         rval = ABSENT
-        for fn in self.rules[rulename]:
-            args = self.build()
-            _, names = get_names(fn)
-            if may_fail and set(args) != set(names):
-                return ABSENT
-            else:
-                rval = fn(**args)
+        fns = self.rules[rulename]
+        if not fns:
+            return rval
+        args = self.build()
+        for fn in fns:
+            if may_fail:
+                _, names = get_names(fn)
+                if not isinstance(names, (set, frozenset)):
+                    names = set(names)
+                if args.keys() != names:
+                    return ABSENT
+            # _ptera_accept may decide to drop the match before the
+            # function is called with the captures
+            accept = getattr(fn, "_ptera_accept", None)
+            if accept is not None and not accept():
+                rval = None
+                continue
+            rval = fn(**args)
         return rval
 
     def merge(self, child):
         for name, cap in child.captures.items():
-            mycap = self.getcap(cap.element)
-            mycap.names += cap.names
-            mycap.values += cap.values
+            self.getcap(cap.element).extend(cap)
+        self._env = None
 
     def leaves(self):
         if not self.children and self.focus:
             return [self]
         else:
             rval = []
-            for child in self.children:
+            for child in self.children or ():
                 rval += child.leaves()
             return rval
 
     def _to_merge(self):
         rval = []
-        for child in self.children:
+        for child in self.children or ():
             if not child.focus:
                 rval.append(child)
                 rval += child._to_merge()
         return rval
 
+    def deliver(self):
+        """Run the listeners of the leaves that can already match.
+
+        This is used to deliver matches before the frame is closed. The
+        leaves that matched are marked COMPLETE and their captures are
+        dropped, and close() will skip them.
+        """
+        if self.status is ACTIVE and self.parent is None:
+            for leaf in self.leaves():
+                if leaf is self or leaf.status is not ACTIVE:
+                    continue
+                if leaf.run("listeners", may_fail=True) is not ABSENT:
+                    leaf.status = COMPLETE
+                    leaf.captures = {}
+                    leaf._env = None
+
     def close(self):
         if self.status is ACTIVE:
             if self.parent is None:
@@ -236,7 +402,8 @@ class Accumulator:
                     self.merge(acc)
                 leaves = self.leaves()
                 for leaf in leaves:
-                    leaf.run("listeners", may_fail=True)
+                    if leaf.status is not COMPLETE:
+                        leaf.run("listeners", may_fail=True)
                 if not leaves:
                     self.run("listeners", may_fail=True)
             self.status = COMPLETE
@@ -261,62 +428,234 @@ class Accumulator:
         return f"Accumulator({self.pattern}, {rval})"
 
 
+@weak_cache
+def _get_names(fn):
+    spec = inspect.getfullargspec(fn)
+    if spec.args and spec.args[0] == "self":
+        return None, frozenset(spec.args[1:])
+    else:
+        return None, frozenset(spec.args)
+
+
 def get_names(fn):
-    if hasattr(fn, "_ptera_argspec"):
-        return fn._ptera_argspec
+    # _ptera_argspec may be set after the first call, so it is not cached
+    spec = getattr(fn, "_ptera_argspec", None)
+    if spec is None:
+        return _get_names(fn)
+    return spec
+
+
+def _listify(entries):
+    if isinstance(entries, (tuple, list)):
+        return entries
     else:
-        spec = inspect.getfullargspec(fn)
-        if spec.args and spec.args[0] == "self":
-            return None, spec.args[1:]
-        else:
-            return None, spec.args
+        return [entries]
+
+
+def _rules_shape(rulesets):
+    """Return a hashable description of the structure of rulesets.
+
+    Two rulesets with the same shape only differ in the identity of the rule
+    functions, so they produce the same patterns and accumulators.
+    """
+    return tuple(
+        tuple(
+            (
+                pattern,
+                tuple(
+                    (
+                        name,
+                        tuple(
+                            (focus, frozenset(names))
+                            for focus, names in map(
+                                get_names, _listify(entries)
+                            )
+                        ),
+                    )
+                    for name, entries in triggers.items()
+                ),
+            )
+            for pattern, triggers in rules.items()
+        )
+        for rules in rulesets
+    )
 
 
-def dict_to_collection(*rulesets):
+@functools.lru_cache(maxsize=256)
+def _collection_plan(shape):
+    """Return the patterns of a collection and the rules they trigger.
+
+    The result is a list of (pattern, names, targets) where each target is a
+    (ruleset_index, pattern_key, rule_name, entry_index) tuple that locates a
+    rule function in the original rulesets.
+    """
     tmp = {}
-    for rules in rulesets:
-        for pattern, triggers in rules.items():
-            pattern = to_pattern(pattern)
-            for name, entries in triggers.items():
-                if not isinstance(entries, (tuple, list)):
-                    entries = [entries]
-                for entry in entries:
-                    focus, names = get_names(entry)
+    for i, rules in enumerate(shape):
+        for key, triggers in rules:
+            pattern = to_pattern(key)
+            for name, entries in triggers:
+                for j, (focus, names) in enumerate(entries):
                     this_pattern = pattern.rewrite(names, focus=focus)
                     if this_pattern not in tmp:
-                        tmp[this_pattern] = Accumulator(
-                            names, pattern=this_pattern
-                        )
-                    acc = tmp[this_pattern]
-                    acc.rules[name].append(entry)
-    return PatternCollection(list(tmp.items()))
+                        tmp[this_pattern] = (names, [])
+                    tmp[this_pattern][1].append((i, key, name, j))
+    return tuple(
+        (pattern, names, tuple(targets))
+        for pattern, (names, targets) in tmp.items()
+    )
+
+
+def plan_collection(*rulesets):
+    """Return a plan to build a collection from rulesets of this shape."""
+    return _collection_plan(_rules_shape(rulesets))
+
+
+def instantiate_plan(plan, rulesets, compiled=False):
+    """Create a collection from a plan, using the rule functions in rulesets.
+
+    The rulesets must have the shape that was used to create the plan.
+    """
+    patterns = []
+    for pattern, names, targets in plan:
+        acc = Accumulator(names, pattern=pattern)
+        for i, key, name, j in targets:
+            acc.rules[name].append(_listify(rulesets[i][key][name])[j])
+        patterns.append((pattern, acc))
+    if compiled:
+        return CompiledPatternCollection(patterns)
+    return PatternCollection(patterns)
+
+
+def dict_to_collection(*rulesets, compiled=False):
+    return instantiate_plan(
+        plan_collection(*rulesets), rulesets, compiled=compiled
+    )
+
+
+class PatternIndex:
+    """Immutable set of (pattern, accumulator) pairs, indexed by function name.
+
+    Patterns that match any function (`*`) are kept in a separate bucket, so
+    looking up the candidates for a function only touches the patterns that
+    can match it. The insertion order of the entries is preserved.
+    """
+
+    def __init__(self, entries=()):
+        self.by_name = {}
+        self.wildcards = []
+        self.size = 0
+        self._add(entries)
+
+    def _add(self, entries):
+        for entry in entries:
+            name = entry[0].element.name
+            if name is None:
+                self.wildcards.append((self.size, entry))
+            else:
+                self.by_name.setdefault(name, []).append((self.size, entry))
+            self.size += 1
+
+    def extend(self, entries):
+        """Return a new index with additional entries.
+
+        The buckets that are not affected by the new entries are shared with
+        this index.
+        """
+        if not entries:
+            return self
+        rval = PatternIndex()
+        rval.by_name = dict(self.by_name)
+        for name in {entry[0].element.name for entry in entries}:
+            if name is not None and name in rval.by_name:
+                rval.by_name[name] = list(rval.by_name[name])
+        rval.wildcards = list(self.wildcards)
+        rval.size = self.size
+        rval._add(entries)
+        return rval
+
+    def candidates(self, fname):
+        """Return the entries that may match the function named fname."""
+        named = self.by_name.get(fname, None)
+        if not named:
+            return [entry for _, entry in self.wildcards]
+        elif not self.wildcards:
+            return [entry for _, entry in named]
+        else:
+            return [entry for _, entry in sorted(named + self.wildcards)]
+
+    @property
+    def entries(self):
+        rval = list(self.wildcards)
+        for bucket in self.by_name.values():
+            rval += bucket
+        return [entry for _, entry in sorted(rval, key=lambda x: x[0])]
+
+    def __len__(self):
+        return self.size
 
 
 class PatternCollection:
     current = ContextVar("PatternCollection.current", default=None)
 
-    def __init__(self, patterns=None):
-        self.patterns = patterns or []
+    def __init__(self, patterns=None, nested=None, immediate=None):
+        if patterns is not None:
+            assert nested is None and immediate is None
+            nested = [(p, acc) for p, acc in patterns if not p.immediate]
+            immediate = [(p, acc) for p, acc in patterns if p.immediate]
+            nested = PatternIndex(nested)
+            immediate = PatternIndex(immediate)
+        # Patterns in nested stay active in all nested calls, patterns in
+        # immediate only apply to the next call.
+        self.nested = nested or PatternIndex()
+        self.immediate = immediate or PatternIndex()
+
+    @property
+    def patterns(self):
+        return self.nested.entries + self.immediate.entries
+
+    def merge(self, other):
+        if isinstance(other, CompiledPatternCollection):
+            return CompiledPatternCollection(self.patterns + other.patterns)
+        return PatternCollection(
+            nested=self.nested.extend(other.nested.entries),
+            immediate=self.immediate.extend(other.immediate.entries),
+        )
 
     def proceed(self, fname, frame):
-        next_patterns = []
-        to_process = list(self.patterns)
+        to_process = self.nested.candidates(fname)
+        if self.immediate:
+            to_process += self.immediate.candidates(fname)
+        elif not to_process:
+            # Nothing matches and nothing expires, so nested calls see the
+            # exact same patterns
+            return self
+        to_process.reverse()
+
+        new_nested = []
+        new_immediate = []
         while to_process:
             pattern, acc = to_process.pop()
             ename = pattern.element.name
-            if not pattern.immediate:
-                next_patterns.append((pattern, acc))
-            if ename is None or ename == fname:
-                is_template = acc.template
-                acc = acc.fork(focus=pattern.focus or is_template)
-                frame.register(acc, pattern.captures, close_at_exit=is_template)
-                for child in pattern.children:
+            if ename is not None and ename != fname:
+                continue
+            is_template = acc.template
+            acc = acc.fork(focus=pattern.focus or is_template)
+            frame.register(acc, pattern.captures, close_at_exit=is_template)
+            for child in pattern.children:
+                if child.immediate:
+                    new_immediate.append((child, acc))
+                else:
+                    new_nested.append((child, acc))
                     if child.collapse:
                         to_process.append((child, acc))
-                    else:
-                        next_patterns.append((child, acc))
-        rval = PatternCollection(next_patterns)
-        return rval
+
+        nested = self.nested.extend(new_nested)
+        if not nested and not new_immediate:
+            # Nothing can match deeper, so nested calls can take the fast path
+            return None
+        return PatternCollection(
+            nested=nested, immediate=PatternIndex(new_immediate)
+        )
 
     def show(self):
         for pattern, acc in self.patterns:
@@ -346,26 +685,45 @@ def proceed(fname):
 
 
 @contextmanager
-def overlay(*rulesets):
+def overlay(*rulesets, compiled=False):
     rulesets = [rules for rules in rulesets if rules]
 
     if not rulesets:
         yield None
 
     else:
-        collection = dict_to_collection(*rulesets)
-        curr = PatternCollection.current.get()
-        if curr is not None:
-            collection.patterns = curr.patterns + collection.patterns
-        with setvar(PatternCollection.current, collection):
+        collection = dict_to_collection(*rulesets, compiled=compiled)
+        with overlay_collection(collection):
             yield collection
 
 
+@contextmanager
+def overlay_collection(collection):
+    if collection is None:
+        yield None
+        return
+    curr = PatternCollection.current.get()
+    if curr is not None:
+        collection = curr.merge(collection)
+    with setvar(PatternCollection.current, collection):
+        yield collection
+
+
 def interact(sym, key, category, __self__, value):
     from_state = __self__.get(sym)
+    fr = Frame.top.get()
+
+    if fr is None:
+        # Fast path: no pattern can match this frame, so the only thing left
+        # to do is to resolve priority between the value and the state.
+        if from_state is ABSENT:
+            if value is ABSENT:
+                raise NameError(f"Variable {sym} of {__self__} is not set.")
+            return value.value if isinstance(value, Override) else value
+        success, value = choose([value, from_state])
+        return value
 
     if key is None:
-        fr = Frame.top.get()
         try:
             fr_value = fr.get(sym, key, category)
         except NameError:
@@ -390,11 +748,89 @@ def interact(sym, key, category, __self__, value):
                 return value
 
 
+class MapView(Sequence):
+    """Lazy projection of a Collector's data.
+
+    Entries are projected when they are accessed, so a view does not copy
+    the data. It supports iteration, len, indexing and slicing (a slice is
+    another view) and compares equal to a list with the same elements. A
+    view is live: entries collected after it is created are visible.
+
+    Arguments:
+        data: The list of entries to project.
+        project: Function applied to an entry to get the element.
+        indices: A range of indices into data, or None for all of data.
+    """
+
+    __slots__ = ("_data", "_project", "_indices")
+
+    def __init__(self, data, project, indices=None):
+        self._data = data
+        self._project = project
+        self._indices = indices
+
+    def _range(self):
+        if self._indices is None:
+            return range(len(self._data))
+        else:
+            return self._indices
+
+    def __len__(self):
+        return len(self._range())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return MapView(self._data, self._project, self._range()[item])
+        else:
+            return self._project(self._data[self._range()[item]])
+
+    def __iter__(self):
+        if self._indices is None:
+            return map(self._project, self._data)
+        else:
+            return map(self.__getitem__, range(len(self._indices)))
+
+    def __eq__(self, other):
+        if isinstance(other, (MapView, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __str__(self):
+        return f"MapView({list(self)})"
+
+    __repr__ = __str__
+
+
+def _project_one(name, transform_one):
+    return lambda entry: transform_one(entry[name])
+
+
+def _project_many(names, transform_one):
+    return lambda entry: tuple(transform_one(entry[name]) for name in names)
+
+
+def _project_call(fn, transform_all):
+    return lambda entry: call_with_captures(fn, transform_all(entry))
+
+
+def _identity(entry):
+    return entry
+
+
+def _entry_values(entry):
+    return {key: cap.value for key, cap in entry.items()}
+
+
+def _entry_all_values(entry):
+    return {key: cap.values for key, cap in entry.items()}
+
+
 class Collector:
     def __init__(self, pattern, finalize=None):
         self.data = []
         self.pattern = to_pattern(pattern)
         self.finalizer = finalize
+        self._views = {}
 
         def listener(**kwargs):
             self.data.append(kwargs)
@@ -405,49 +841,64 @@ class Collector:
     def __iter__(self):
         return iter(self.data)
 
-    def _map_helper(self, args, transform_all, transform_one):
-        if not args:
-            return transform_all(self)
-        elif isinstance(args[0], str):
-            assert all(isinstance(arg, str) for arg in args)
-            results = tuple(
-                [transform_one(entry[arg]) for entry in self] for arg in args
-            )
-            if len(args) == 1:
-                return results[0]
-            else:
-                return list(zip(*results))
-        else:
+    def __getstate__(self):
+        # The listener and finalizer are usually closures, and they are not
+        # needed anymore once the results are finalized
+        state = dict(self.__dict__)
+        for attr in ("_listener", "_views", "finalizer"):
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.finalizer = None
+        self._views = {}
+
+    def merge(self, other):
+        """Add the data of another Collector for the same pattern."""
+        self.data.extend(other.data)
+        return self
+
+    def _map_helper(self, kind, args, transform_all, transform_one):
+        if args and not isinstance(args[0], str):
             assert len(args) == 1
             (fn,) = args
-            return [
-                call_with_captures(fn, entry) for entry in transform_all(self)
-            ]
+            return MapView(self.data, _project_call(fn, transform_all))
+        assert all(isinstance(arg, str) for arg in args)
+        key = (kind, args)
+        view = self._views.get(key, None)
+        if view is None:
+            if not args:
+                project = transform_all
+            elif len(args) == 1:
+                project = _project_one(args[0], transform_one)
+            else:
+                project = _project_many(args, transform_one)
+            view = self._views[key] = MapView(self.data, project)
+        return view
 
     def map(self, *args):
         return self._map_helper(
+            kind="map",
             args=args,
-            transform_all=lambda self: [
-                {key: cap.value for key, cap in entry.items()} for entry in self
-            ],
-            transform_one=lambda entry: entry.value,
+            transform_all=_entry_values,
+            transform_one=attrgetter("value"),
         )
 
     def map_all(self, *args):
         return self._map_helper(
+            kind="map_all",
             args=args,
-            transform_all=lambda self: [
-                {key: cap.values for key, cap in entry.items()}
-                for entry in self
-            ],
-            transform_one=lambda entry: entry.values,
+            transform_all=_entry_all_values,
+            transform_one=attrgetter("values"),
         )
 
     def map_full(self, *args):
         return self._map_helper(
+            kind="map_full",
             args=args,
-            transform_all=lambda self: self,
-            transform_one=lambda entry: entry,
+            transform_all=_identity,
+            transform_one=_identity,
         )
 
     def rules(self):
@@ -475,6 +926,26 @@ class Tap:
         return Collector(self.selector, self.finalize)
 
 
+def merge_results(results):
+    """Merge the results of the same plugin over several calls.
+
+    Results that have a merge method, such as Collectors, are merged into
+    the first one. Lists are concatenated. Anything else is returned as the
+    list of results.
+    """
+    if not results:
+        return []
+    first, *rest = results
+    if hasattr(first, "merge"):
+        for result in rest:
+            first = first.merge(result)
+        return first
+    elif all(isinstance(result, list) for result in results):
+        return list(chain.from_iterable(results))
+    else:
+        return list(results)
+
+
 class CallResults:
     def __init__(self, value):
         self.value = value
@@ -516,6 +987,69 @@ def _collect_plugins(plugins, kwplugins):
     return plugins, any(p.hasoutput for name, p in plugins.items())
 
 
+def _lookup_function(module, qualname):
+    if "<locals>" in qualname:
+        return None
+    rval = importlib.import_module(module)
+    for part in qualname.split("."):
+        rval = getattr(rval, part, None)
+    return rval if isinstance(rval, PteraFunction) else None
+
+
+def _restore_function(module, qualname, state, callkey, plugins, return_object):
+    base = _lookup_function(module, qualname)
+    rval = base.clone(
+        callkey=callkey, plugins=plugins, return_object=return_object
+    )
+    for name, value in state.items():
+        setattr(rval.state, name, value)
+    return rval
+
+
+def _pmap_call(fn, *args):
+    callres = fn(*args)
+    if not isinstance(callres, CallResults):
+        # Calls without plugins return the value directly
+        return callres, {}
+    outputs = {
+        name: getattr(callres, name)
+        for name, plugin in fn.plugins.items()
+        if plugin.hasoutput
+    }
+    return callres.value, outputs
+
+
+def _run(fn, *args):
+    return fn(*args)
+
+
+def _forward(gen, run, after=None):
+    """Generator that forwards the items, sends and throws of gen.
+
+    Arguments:
+        gen: The generator to forward.
+        run: Called as run(fn, *args) to call the methods of gen, like
+            Context.run. It can run them in another context.
+        after: Function to call after each item produced by gen.
+    """
+    method, arg = gen.send, None
+    while True:
+        try:
+            item = run(method, arg)
+        except StopIteration as exc:
+            return exc.value
+        if after is not None:
+            after()
+        try:
+            arg = yield item
+            method = gen.send
+        except GeneratorExit:
+            run(gen.close)
+            raise
+        except BaseException as exc:
+            method, arg = gen.throw, exc
+
+
 class PteraFunction(Selfless):
     def __init__(
         self, fn, state, callkey=None, plugins=None, return_object=False
@@ -524,11 +1058,15 @@ class PteraFunction(Selfless):
         self.callkey = callkey
         self.plugins = plugins or {}
         self.return_object = return_object
+        if isinstance(fn, PreFunction):
+            fn = fn.fn
+        self._is_async = inspect.iscoroutinefunction(fn)
+        self._is_generator = inspect.isgeneratorfunction(fn)
 
     def clone(self, **kwargs):
         kwargs = {
             "fn": self.fn,
-            "state": copy(self.state),
+            "state": self.state.__copy__(),
             "callkey": self.callkey,
             "plugins": self.plugins,
             "return_object": self.return_object,
@@ -540,6 +1078,71 @@ class PteraFunction(Selfless):
         assert self.callkey is None
         return self.clone(callkey=callkey)
 
+    def __reduce__(self):
+        # The rewritten function cannot be pickled, so it is pickled as the
+        # module and qualified name of the PteraFunction it comes from, plus
+        # the state variables that differ from it.
+        base = _lookup_function(self.fn.__module__, self.fn.__qualname__)
+        if base is None or base.fn is not self.fn:
+            raise pickle.PicklingError(
+                f"Can't pickle {self}: it is not found as"
+                f" {self.fn.__module__}.{self.fn.__qualname__}"
+            )
+        state = {}
+        for name in type(self.state).__variables__:
+            value = getattr(self.state, name, ABSENT)
+            if value is not getattr(base.state, name, ABSENT):
+                state[name] = value
+        return (
+            _restore_function,
+            (
+                self.fn.__module__,
+                self.fn.__qualname__,
+                state,
+                self.callkey,
+                self.plugins,
+                self.return_object,
+            ),
+        )
+
+    def pmap(self, *iterables, executor=None, max_workers=None):
+        """Call this function on many arguments in worker processes.
+
+        Like the builtin map, the function is called with one argument
+        taken from each iterable. The function, its state and its plugins
+        are pickled and sent to the workers, so they must be defined at the
+        module level. The results of each plugin are combined over all calls
+        with merge_results.
+
+        Arguments:
+            iterables: The arguments of the calls.
+            executor: A concurrent.futures.Executor. If None, a
+                ProcessPoolExecutor is created for this map.
+            max_workers: The number of processes, if executor is None.
+
+        Returns:
+            The list of return values, or CallResults with the list of
+            return values and the merged results of the plugins, if a plugin
+            has an output.
+        """
+        fn = self.clone(return_object=True)
+        call = functools.partial(_pmap_call, fn)
+        if executor is None:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                outputs = list(executor.map(call, *iterables))
+        else:
+            outputs = list(executor.map(call, *iterables))
+
+        values = [value for value, _ in outputs]
+        if not self.return_object:
+            return values
+        callres = CallResults(values)
+        for name, plugin in self.plugins.items():
+            if plugin.hasoutput:
+                results = [plugins[name] for _, plugins in outputs]
+                setattr(callres, name, merge_results(results))
+        return callres
+
     def tweak(self, values, priority=2):
         values = {
             k: lambda __v=v, **_: override(__v, priority)
@@ -572,6 +1175,102 @@ class PteraFunction(Selfless):
         self.plugins.update(plugins)
         return self
 
+    def _variant(self, frame):
+        """Return the version of fn that only instruments what is needed.
+
+        Variables that are set in the state or that may be captured by an
+        accumulator in the frame must go through interact, the others can be
+        left alone.
+        """
+        variants = getattr(self.fn, "_ptera_variants", None)
+        if variants is None:
+            return self.fn
+        state = self.state
+        if frame is None:
+            # Without a frame, the variant only depends on the state, so it
+            # is cached there until a variable is set
+            cached = state._ptera_variant
+            if cached is not None and cached[0] is self.fn:
+                return cached[1]
+            accs = {}
+        else:
+            accs = frame.accumulators
+            if accs.get(None, None):
+                return variants.get(None)
+        needed = {
+            name
+            for name, value in zip(
+                type(state).__variables__, state._ptera_values
+            )
+            if value is not ABSENT and name in variants.optional
+        }
+        needed.update(name for name, entries in accs.items() if entries)
+        rval = variants.get(needed)
+        if frame is None:
+            state._ptera_variant = (self.fn, rval)
+        return rval
+
+    def _call_fast(self, args, kwargs):
+        # No pattern is active and no plugin is attached: run the function
+        # without a frame, which makes interact resolve values directly.
+        fn = self._variant(None)
+        if Frame.top.get() is None:
+            return self._call_with(fn, args, kwargs)
+        token = Frame.top.set(None)
+        try:
+            return self._call_with(fn, args, kwargs)
+        finally:
+            Frame.top.reset(token)
+
+    @contextmanager
+    def _instrument(self):
+        """Set up the frame and patterns for a call.
+
+        Yields the variant of fn to call and the instantiated plugins.
+        """
+        with newframe() as frame:
+            plugins = {
+                name: p.instantiate() for name, p in self.plugins.items()
+            }
+            rulesets = [plugin.rules() for plugin in plugins.values()]
+            rulesets = [rules for rules in rulesets if rules]
+            if rulesets:
+                # Plans are cached by the shape of the rulesets, so this is
+                # only computed on the first call with these plugins
+                plan = plan_collection(*rulesets)
+                collection = instantiate_plan(plan, rulesets)
+            else:
+                collection = None
+            with overlay_collection(collection):
+                with proceed(self.fn.__name__):
+                    if self.callkey is not None:
+                        interact("#key", None, None, self, self.callkey)
+                    yield self._variant(frame), plugins
+
+    def _results(self, rval, plugins):
+        callres = CallResults(rval)
+        for name, plugin in plugins.items():
+            setattr(callres, name, plugin.finalize())
+
+        if self.return_object:
+            return callres
+        else:
+            return rval
+
+    async def _acall(self, args, kwargs):
+        # The frame must stay active while the coroutine runs, so it is set
+        # up inside a coroutine. Each asyncio task has its own context, so
+        # concurrent calls do not see each other's frames and patterns.
+        if not self.plugins and PatternCollection.current.get() is None:
+            token = Frame.top.set(None)
+            try:
+                return await self._call_with(self._variant(None), args, kwargs)
+            finally:
+                Frame.top.reset(token)
+        with self._instrument() as (fn, plugins):
+            rval = await self._call_with(fn, args, kwargs)
+        return self._results(rval, plugins)
+
     def collect(self, query):
         plugin = _to_plugin(query)
 
@@ -586,35 +1285,41 @@ class PteraFunction(Selfless):
         def deco(fn):
             def finalize(coll):
                 if full:
-                    return coll.map_full(fn)
+                    return list(coll.map_full(fn))
                 elif all:
-                    return coll.map_all(fn)
+                    return list(coll.map_all(fn))
                 else:
-                    return coll.map(fn)
+                    return list(coll.map(fn))
 
             self.plugins[fn.__name__] = plugin.hook(finalize)
 
         return deco
 
-    def __call__(self, *args, **kwargs):
-        rulesets = []
-        with newframe():
-            plugins = {
-                name: p.instantiate() for name, p in self.plugins.items()
-            }
-            for plugin in plugins.values():
-                rulesets.append(plugin.rules())
-            with overlay(*rulesets):
-                with proceed(self.fn.__name__):
-                    if self.callkey is not None:
-                        interact("#key", None, None, self, self.callkey)
-                    rval = super().__call__(*args, **kwargs)
+    def _gcall(self, args, kwargs):
+        # The generator runs in its own copy of the context, taken at call
+        # time, so that its frame stays active across yields without
+        # leaking into the code that consumes it.
+        ctx = contextvars.copy_context()
+        return _forward(self._ginstrument(args, kwargs), ctx.run)
+
+    def _ginstrument(self, args, kwargs):
+        if not self.plugins and PatternCollection.current.get() is None:
+            Frame.top.set(None)
+            fn = self._variant(None)
+            return (yield from self._call_with(fn, args, kwargs))
+        with self._instrument() as (fn, plugins):
+            frame = Frame.top.get()
+            gen = self._call_with(fn, args, kwargs)
+            rval = yield from _forward(gen, _run, frame.deliver)
+        return self._results(rval, plugins)
 
-        callres = CallResults(rval)
-        for name, plugin in plugins.items():
-            setattr(callres, name, plugin.finalize())
-
-        if self.return_object:
-            return callres
-        else:
-            return rval
+    def __call__(self, *args, **kwargs):
+        if self._is_async:
+            return self._acall(args, kwargs)
+        elif self._is_generator:
+            return self._gcall(args, kwargs)
+        if not self.plugins and PatternCollection.current.get() is None:
+            return self._call_fast(args, kwargs)
+        with self._instrument() as (fn, plugins):
+            rval = self._call_with(fn, args, kwargs)
+        return self._results(rval, plugins)
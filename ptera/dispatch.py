@@ -0,0 +1,161 @@
+"""Run the listeners of a plugin in the background.
+
+Listeners normally run inside the instrumented function, when the
+accumulator for a match is closed. BackgroundTap wraps a plugin so that its
+listeners only take a snapshot of the captures there and run later, on a
+worker thread.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .core import _listify, _to_plugin, get_names
+
+
+class Dispatcher:
+    """Run functions in order on an executor.
+
+    Functions submitted to the same Dispatcher run one at a time, in
+    submission order, even if the executor has several workers. Several
+    dispatchers can therefore share an executor without losing ordering.
+
+    Arguments:
+        executor: A concurrent.futures.Executor. If None, the Dispatcher
+            creates its own single thread, which is shut down by close().
+    """
+
+    def __init__(self, executor=None):
+        self.owned = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+        self.executor = executor
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.running = False
+        self.errors = []
+
+    def submit(self, fn, kwargs):
+        with self.lock:
+            self.queue.append((fn, kwargs))
+            if not self.running:
+                self.running = True
+                self.idle.clear()
+                self.executor.submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.running = False
+                    self.idle.set()
+                    return
+                fn, kwargs = self.queue.popleft()
+            try:
+                fn(**kwargs)
+            except Exception as exc:
+                self.errors.append(exc)
+
+    def flush(self):
+        """Wait until all submitted functions have run.
+
+        The first exception raised by one of them, if any, is raised again.
+        """
+        self.idle.wait()
+        if self.errors:
+            exc = self.errors[0]
+            self.errors.clear()
+            raise exc
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.owned:
+                self.executor.shutdown()
+
+
+def _background(fn, dispatcher):
+    def listener(**kwargs):
+        dispatcher.submit(
+            fn, {name: cap.snapshot() for name, cap in kwargs.items()}
+        )
+
+    listener._ptera_argspec = get_names(fn)
+    return listener
+
+
+class _BackgroundPlugin:
+    def __init__(self, plugin, executor):
+        self.plugin = plugin
+        self.dispatcher = Dispatcher(executor)
+
+    def rules(self):
+        rules = self.plugin.rules()
+        return {
+            pattern: {
+                key: (
+                    [_background(fn, self.dispatcher) for fn in _listify(fns)]
+                    if key == "listeners"
+                    else fns
+                )
+                for key, fns in entries.items()
+            }
+            for pattern, entries in rules.items()
+        }
+
+    def flush(self):
+        self.dispatcher.flush()
+
+    def finalize(self):
+        self.dispatcher.close()
+        return self.plugin.finalize()
+
+
+class BackgroundTap:
+    """Plugin that runs the listeners of another plugin in the background.
+
+    The captures of a match are copied when the match completes and the
+    listeners run on a worker thread, in the order in which the matches
+    completed. `finalize` waits for all of them before finalizing the
+    wrapped plugin, and raises the first exception a listener raised.
+
+    Arguments:
+        plugin: A plugin, such as a Tap, or a selector for a Tap.
+        executor: A concurrent.futures.Executor to run the listeners on.
+            Ordering is preserved even if it has several workers. If None,
+            the tap creates a single worker thread when it is first used,
+            which all calls share and close() shuts down.
+    """
+
+    def __init__(self, plugin, executor=None):
+        self.plugin = _to_plugin(plugin)
+        self.executor = executor
+        self.owned = executor is None
+        self.lock = threading.Lock()
+
+    @property
+    def hasoutput(self):
+        return self.plugin.hasoutput
+
+    def hook(self, finalize):
+        self.plugin = self.plugin.hook(finalize)
+        return self
+
+    def _executor(self):
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=1)
+        return self.executor
+
+    def instantiate(self):
+        return _BackgroundPlugin(self.plugin.instantiate(), self._executor())
+
+    def close(self):
+        """Shut down the worker thread, if it was created by the tap."""
+        if self.owned and self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
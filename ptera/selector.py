@@ -2,6 +2,7 @@
 
 
 from dataclasses import dataclass, replace as dc_replace
+from functools import lru_cache
 
 from . import opparse
 from .categories import Category
@@ -438,6 +439,7 @@ def make_symbol(node, context):
     return element
 
 
+@lru_cache(maxsize=1024)
 def parse(x):
     return evaluate(parser(x))
 
@@ -1,31 +1,24 @@
 import ast
 import builtins
+import hashlib
 import inspect
+import linecache
+import marshal
+import os
+import re
+import sys
+import threading
 import tokenize
 from ast import NodeTransformer, NodeVisitor
-from copy import copy
+from copy import deepcopy
 from textwrap import dedent
 
 from .utils import ABSENT, keyword_decorator
+from .version import version
 
 idx = 0
 
 
-def readline_mock(src):
-    curr = -1
-    src = bytes(src, encoding="utf8")
-    lines = [line + b"\n" for line in src.split(b"\n")]
-
-    def readline():
-        nonlocal curr
-        curr = curr + 1
-        if curr >= len(lines):
-            raise StopIteration
-        return lines[curr]
-
-    return readline
-
-
 def gensym():
     global idx
     idx += 1
@@ -52,8 +45,28 @@ class ExternalVariableCollector(NodeVisitor):
 
 
 class PteraTransformer(NodeTransformer):
-    def __init__(self, tree, comments):
+    """Rewrite a function to call interact on each variable.
+
+    Each interaction site refers to its symbol and category through the
+    variables ``__ptera_s<i>`` and ``__ptera_c<i>``, where ``i`` is the index
+    of the site's (name, annotation) pair in ``sites``. `_compile` wraps the
+    function in a factory that takes these as arguments.
+
+    Arguments:
+        tree: The FunctionDef to rewrite.
+        comments: The comments by line number.
+        skip: Names of the variables that should not be instrumented.
+        sites: A list of (name, annotation) to number the sites from, so
+            that all variants of a function use the same numbering.
+    """
+
+    def __init__(self, tree, comments, skip=frozenset(), sites=()):
         super().__init__()
+        self.skip = skip
+        self.sites = list(sites)
+        self._site_index = {
+            (name, ann): i for i, (name, ann) in enumerate(self.sites)
+        }
         evc = ExternalVariableCollector(comments)
         evc.visit(tree)
         self.vardoc = evc.vardoc
@@ -62,6 +75,8 @@ class PteraTransformer(NodeTransformer):
         self.external = evc.used - evc.assigned
         self.annotated = {}
         self.defaults = {}
+        self.has_yield = False
+        self.site_annotations = {}
         self.result = self.visit_FunctionDef(tree, root=True)
 
     def fself(self):
@@ -70,25 +85,46 @@ class PteraTransformer(NodeTransformer):
     def _absent(self):
         return ast.Name("__ptera_ABSENT", ctx=ast.Load())
 
+    def site(self, name, ann):
+        """Return the symbol and category arguments for an interaction."""
+        key = (name, None if ann is None else ast.dump(ann))
+        i = self._site_index.get(key, None)
+        if i is None:
+            i = self._site_index[key] = len(self.sites)
+            self.sites.append(key)
+            if ann is not None:
+                self.site_annotations[i] = ann
+        return [
+            ast.Name(f"__ptera_s{i}", ctx=ast.Load()),
+            ast.Name(f"__ptera_c{i}", ctx=ast.Load()),
+        ]
+
     def make_interaction(self, target, ann, value):
+        if (
+            ann is None
+            and isinstance(target, ast.Name)
+            and target.id in self.skip
+        ):
+            return [ast.Assign(targets=[target], value=value)]
         if ann and isinstance(target, ast.Name):
             self.annotated[target.id] = ann
-        ann_arg = ann if ann else ast.Constant(value=None)
         value_arg = self._absent() if value is None else value
         if isinstance(target, ast.Name):
+            sym, category = self.site(target.id, ann)
             value_args = [
-                ast.Constant(value=target.id),
+                sym,
                 ast.Constant(value=None),
                 # self._absent(),
-                ann_arg,
+                category,
                 self.fself(),
                 value_arg,
             ]
         elif isinstance(target, ast.Subscript):
+            sym, category = self.site(target.value.id, ann)
             value_args = [
-                ast.Constant(value=target.value.id),
+                sym,
                 target.slice.value,
-                ann_arg,
+                category,
                 self.fself(),
                 value_arg,
             ]
@@ -161,7 +197,7 @@ class PteraTransformer(NodeTransformer):
                 new_body.extend(stmt)
             else:
                 new_body.append(stmt)
-        return ast.FunctionDef(
+        return type(node)(
             name=node.name,
             args=new_args,
             body=new_body,
@@ -170,19 +206,34 @@ class PteraTransformer(NodeTransformer):
             # type_comment=node.type_comment,
         )
 
-    def visit_Return(self, node):
-        new_value = ast.Call(
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def _interact_special(self, name, value):
+        sym, category = self.site(name, None)
+        return ast.Call(
             func=ast.Name("__ptera_interact", ctx=ast.Load()),
-            args=[
-                ast.Constant(value="#value"),
-                ast.Constant(value=None),
-                ast.Constant(value=None),
-                self.fself(),
-                node.value,
-            ],
+            args=[sym, ast.Constant(value=None), category, self.fself(), value],
             keywords=[],
         )
-        return ast.Return(value=new_value)
+
+    def visit_Return(self, node):
+        if "#value" in self.skip:
+            return node
+        return ast.Return(value=self._interact_special("#value", node.value))
+
+    def visit_Yield(self, node):
+        """Rewrite a yield expression.
+
+        Before::
+            yield x
+
+        After::
+            yield ptera.interact('#yield', None, x)
+        """
+        self.has_yield = True
+        if "#yield" in self.skip or node.value is None:
+            return node
+        return ast.Yield(value=self._interact_special("#yield", node.value))
 
     def visit_AnnAssign(self, node):
         """Rewrite an annotated assignment expression.
@@ -193,7 +244,8 @@ class PteraTransformer(NodeTransformer):
         After::
             x: int = ptera.interact('x', int)
         """
-        return self.make_interaction(node.target, node.annotation, node.value)
+        value = None if node.value is None else self.visit(node.value)
+        return self.make_interaction(node.target, node.annotation, value)
 
     def visit_Assign(self, node):
         """Rewrite an assignment expression.
@@ -225,64 +277,377 @@ class PteraTransformer(NodeTransformer):
                 )
             return accum
         else:
-            return self.make_interaction(target, None, node.value)
+            return self.make_interaction(target, None, self.visit(node.value))
 
 
-def transform(fn, interact):
-    src = dedent(inspect.getsource(fn))
-
-    comments = {}
-    for tok in tokenize.tokenize(readline_mock(src)):
-        if tok.type == tokenize.COMMENT:
-            if tok.line.strip().startswith("#"):
-                line = tok.end[0]
-                comments[line + 1] = tok.string[1:].strip()
-                if line in comments:
-                    comments[line + 1] = (
-                        comments[line] + "\n" + comments[line + 1]
-                    )
-                    del comments[line]
+def _compile(tree, comments, filename, lineno, skip=frozenset(), sites=()):
+    """Compile the rewritten function into a module that defines a factory.
+
+    The factory, ``__ptera_factory``, takes the symbols then the categories
+    of the sites of the function and returns the function.
+    """
+    transformer = PteraTransformer(
+        deepcopy(tree), comments, skip=skip, sites=sites
+    )
+    new_tree = transformer.result
+    n = len(transformer.sites)
+    params = [f"__ptera_s{i}" for i in range(n)]
+    params += [f"__ptera_c{i}" for i in range(n)]
+    # If the function refers to its own name, that name is an external
+    # variable which the function assigns locally through an interaction, so
+    # the factory's binding of the name is never read.
+    name = new_tree.name
+    factory = ast.FunctionDef(
+        name="__ptera_factory",
+        args=ast.arguments(
+            args=[ast.arg(arg=param, annotation=None) for param in params],
+            vararg=None,
+            kwonlyargs=[],
+            kw_defaults=[],
+            kwarg=None,
+            defaults=[],
+        ),
+        body=[new_tree, ast.Return(value=ast.Name(name, ctx=ast.Load()))],
+        decorator_list=[],
+        returns=None,
+    )
+    ast.copy_location(factory, new_tree)
+    ast.fix_missing_locations(factory)
+    ast.increment_lineno(factory, lineno - 1)
+    code = compile(
+        ast.Module(body=[factory], type_ignores=[]), filename, "exec"
+    )
+    return transformer, code
+
+
+class Variants:
+    """Versions of a transformed function that skip some interactions.
+
+    Only the variables in ``optional`` (plain local variables and the return
+    value) may be skipped. Each variant is compiled the first time it is
+    requested, which is also when the source is parsed, if it was not.
+    """
+
+    def __init__(
+        self, fn, src, comments, filename, lineno, optional, sites, args
+    ):
+        self.src = src
+        self.comments = comments
+        self.filename = filename
+        self.lineno = lineno
+        self.optional = frozenset(optional)
+        # Sites of the full function, and the arguments of its factory
+        self.sites = sites
+        self.args = args
+        self.cache = {frozenset(): fn}
+        self._tree = None
+
+    def get(self, needed):
+        """Return a variant that performs interactions for needed variables.
+
+        Arguments:
+            needed: The names of the variables that must be instrumented,
+                or None if all variables must be.
+        """
+        skip = frozenset() if needed is None else self.optional - needed
+        rval = self.cache.get(skip, None)
+        if rval is None:
+            if self._tree is None:
+                self._tree = _parse(self.src, self.filename)
+            full = self.cache[frozenset()]
+            _, code = _compile(
+                self._tree,
+                self.comments,
+                self.filename,
+                self.lineno,
+                skip,
+                self.sites,
+            )
+            ns = {}
+            exec(code, full.__globals__, ns)
+            rval = ns["__ptera_factory"](*self.args)
+            rval.__qualname__ = full.__qualname__
+            self.cache[skip] = rval
+        return rval
+
+
+class SourceFile:
+    """Lines, tokens and comments of a source file.
+
+    The file is tokenized once, the first time the source of a function is
+    requested, and all the functions in the file are served from the same
+    tokens, so that transforming every function of a module takes time
+    linear in the size of the module.
+    """
+
+    _cache = {}
+
+    def __init__(self, lines):
+        self.lines = lines
+        self._digest = None
+        self._tokens = None
+        # Index of the first token of each line
+        self._line_starts = None
+        self._comments = None
+
+    @classmethod
+    def get(cls, filename, module_globals=None):
+        linecache.checkcache(filename)
+        lines = linecache.getlines(filename, module_globals)
+        if not lines:
+            raise OSError(f"could not get source code for {filename}")
+        rval = cls._cache.get(filename, None)
+        if rval is None or rval.lines is not lines:
+            rval = cls._cache[filename] = cls(lines)
+        return rval
+
+    @property
+    def digest(self):
+        """Hash of the contents of the file, which needs no tokenizing."""
+        if self._digest is None:
+            self._digest = hashlib.sha256(
+                "".join(self.lines).encode("utf8")
+            ).hexdigest()
+        return self._digest
+
+    def _tokenize(self):
+        self._tokens = list(tokenize.generate_tokens(iter(self.lines).__next__))
+        self._line_starts = {}
+        self._comments = {}
+        for i, tok in enumerate(self._tokens):
+            self._line_starts.setdefault(tok.start[0], i)
+            if tok.type == tokenize.COMMENT:
+                if tok.line.strip().startswith("#"):
+                    line = tok.end[0]
+                    self._comments[line + 1] = tok.string[1:].strip()
+                    if line in self._comments:
+                        self._comments[line + 1] = (
+                            self._comments[line]
+                            + "\n"
+                            + self._comments[line + 1]
+                        )
+                        del self._comments[line]
+
+    def function(self, code):
+        """Return the source, comments and first line of a function.
+
+        Arguments:
+            code: The function's code object.
+
+        Returns:
+            A tuple of the function's source, a dict of its full-line
+            comments by line number relative to the source, to be attached
+            to the next line, and its first line in the file.
+        """
+        if self._tokens is None:
+            self._tokenize()
+        lineno = code.co_firstlineno
+        while lineno > 1 and not _def_pattern.match(self.lines[lineno - 1]):
+            lineno -= 1
+
+        finder = inspect.BlockFinder()
+        offset = lineno - 1
+        try:
+            for tok in self._tokens[self._line_starts[lineno] :]:
+                finder.tokeneater(
+                    tok.type,
+                    tok.string,
+                    (tok.start[0] - offset, tok.start[1]),
+                    (tok.end[0] - offset, tok.end[1]),
+                    tok.line,
+                )
+        except (inspect.EndOfBlock, IndentationError):
+            pass
+
+        lines = self.lines[offset : offset + finder.last]
+        comments = {
+            line - offset: comment
+            for line, comment in self._comments.items()
+            if lineno < line <= offset + finder.last
+        }
+        return dedent("".join(lines)), comments, lineno
+
 
-    filename = inspect.getsourcefile(fn)
+_def_pattern = re.compile(r"^(\s*def\s)|(\s*async\s+def\s)|^(\s*@)")
+
+
+def _parse(src, filename):
+    """Return the AST of the function in src."""
     tree = ast.parse(src, filename)
     tree = tree.body[0]
-    assert isinstance(tree, ast.FunctionDef)
+    assert isinstance(tree, (ast.FunctionDef, ast.AsyncFunctionDef))
     tree.decorator_list = []
-    transformer = PteraTransformer(tree, comments)
-    new_tree = transformer.result
-    ast.fix_missing_locations(new_tree)
-    _, lineno = inspect.getsourcelines(fn)
-    ast.increment_lineno(new_tree, lineno - 1)
-    new_fn = compile(
-        ast.Module(body=[new_tree], type_ignores=[]), filename, "exec"
-    )
+    return tree
+
+
+def _analyze(source, code):
+    """Rewrite the function with the given code object.
+
+    Returns a dict of the rewritten code and of the information transform
+    needs about it, in a form that can be serialized with marshal.
+    """
+    filename = code.co_filename
+    src, comments, lineno = source.function(code)
+    tree = _parse(src, filename)
+    transformer, new_code = _compile(tree, comments, filename, lineno)
+
+    def _expr(node):
+        return compile(ast.Expression(node), filename, "eval")
+
+    return {
+        "src": src,
+        "comments": comments,
+        "lineno": lineno,
+        "code": new_code,
+        "defaults": {k: _expr(v) for k, v in transformer.defaults.items()},
+        "annotations": {k: _expr(v) for k, v in transformer.annotated.items()},
+        "vardoc": transformer.vardoc,
+        "used": frozenset(transformer.used),
+        "assigned": frozenset(transformer.assigned),
+        "external": frozenset(transformer.external),
+        "args": tuple(arg.arg for arg in tree.args.args),
+        "has_yield": transformer.has_yield,
+        "sites": tuple(transformer.sites),
+        "site_annotations": {
+            i: _expr(ann) for i, ann in transformer.site_annotations.items()
+        },
+    }
+
+
+# Version of the contents of the cache, to increment when _analyze changes
+_CACHE_FORMAT = 4
+
+
+def _cache_path(code):
+    filename = code.co_filename
+    key = hashlib.sha256(
+        "\0".join(
+            [
+                sys.implementation.cache_tag,
+                version,
+                str(_CACHE_FORMAT),
+                filename,
+                str(code.co_firstlineno),
+            ]
+        ).encode("utf8")
+    ).hexdigest()
+    directory = os.path.join(os.path.dirname(filename), "__pycache__", "ptera")
+    return os.path.join(directory, f"{key[:32]}.bin")
+
+
+def _cached_analyze(source, code):
+    """Same as _analyze, but cached on disk next to the source file.
+
+    The cache is stored under __pycache__/ptera, with one entry per function
+    location, Python version and ptera version. An entry also holds the hash
+    of the file's contents, so that a cached function is found without
+    tokenizing the file, and a stale entry is overwritten rather than
+    accumulating. The cache is disabled if the PTERA_CACHE environment
+    variable is "0", and it is read but not written if
+    sys.dont_write_bytecode is set.
+    """
+    filename = code.co_filename
+    if os.environ.get("PTERA_CACHE", "1") == "0" or not os.path.isfile(
+        filename
+    ):
+        return _analyze(source, code)
+
+    path = _cache_path(code)
+    try:
+        with open(path, "rb") as f:
+            digest, info = marshal.load(f)
+        if digest == source.digest:
+            return info
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    info = _analyze(source, code)
+    if not sys.dont_write_bytecode:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                marshal.dump((source.digest, info), f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+    return info
+
+
+def transform(fn, interact):
+    filename = fn.__code__.co_filename
+    source = SourceFile.get(filename, fn.__globals__)
+    info = _cached_analyze(source, fn.__code__)
+
     glb = fn.__globals__
     glb["__ptera_interact"] = interact
     glb["__ptera_ABSENT"] = ABSENT
-    exec(new_fn, glb, glb)
+    # The function is not defined in glb, where its name is bound to the
+    # decorated function, which may already exist if transform is deferred
+    ns = {}
+    exec(info["code"], glb, ns)
 
-    state = {
-        k: eval(compile(ast.Expression(v), filename, "eval"), glb, glb)
-        for k, v in transformer.defaults.items()
-    }
+    state = {k: eval(code, glb, glb) for k, code in info["defaults"].items()}
 
     annotations = {
-        k: eval(compile(ast.Expression(v), filename, "eval"), glb, glb)
-        for k, v in transformer.annotated.items()
+        k: eval(code, glb, glb) for k, code in info["annotations"].items()
     }
 
     fname = fn.__name__
-    actual_fn = glb[fname]
-    all_vars = transformer.used | transformer.assigned
-    state_obj = state_class(fname, all_vars, transformer.vardoc, annotations)(
-        state
+    all_vars = info["used"] | info["assigned"]
+    state_cls = state_class(fname, all_vars, info["vardoc"], annotations)
+    state_obj = state_cls(state)
+
+    slots = {name: i for i, name in enumerate(state_cls.__variables__)}
+    symbols = []
+    categories = []
+    for i, (name, _) in enumerate(info["sites"]):
+        code = info["site_annotations"].get(i, None)
+        category = None if code is None else eval(code, glb, glb)
+        symbols.append(Symbol(name, slots.get(name, None)))
+        categories.append(category)
+    args = (*symbols, *categories)
+
+    actual_fn = ns["__ptera_factory"](*args)
+    # Functions are pickled by qualified name, see PteraFunction.__reduce__
+    actual_fn.__qualname__ = fn.__qualname__
+    optional = set(
+        info["assigned"]
+        - info["external"]
+        - set(info["annotations"])
+        - set(info["args"])
+    ) | {"#value"}
+    if info["has_yield"]:
+        optional.add("#yield")
+    actual_fn._ptera_variants = Variants(
+        actual_fn,
+        info["src"],
+        info["comments"],
+        filename,
+        info["lineno"],
+        optional,
+        sites=info["sites"],
+        args=args,
     )
     # The necessary globals may not yet be set, so we create a "PreState" that
     # will be filled in whenever we first need to fetch the state.
-    state_obj = PreState(state=state_obj, names=transformer.external, glbls=glb)
+    state_obj = PreState(state=state_obj, names=info["external"], glbls=glb)
     return actual_fn, state_obj
 
 
+class Symbol(str):
+    """Name of the variable at an interaction site.
+
+    A Symbol compares and hashes like the name. It also holds the slot of
+    the variable in the function's state class, or None.
+    """
+
+    def __new__(cls, name, slot=None):
+        rval = super().__new__(cls, name)
+        rval.slot = slot
+        return rval
+
+
 class Override:
     def __init__(self, value, priority=1):
         assert not isinstance(value, Override)
@@ -316,32 +681,111 @@ class PreState:
         return self.state
 
 
+class PreFunction:
+    """Function that is transformed the first time it is needed.
+
+    Selfless objects created with a PreFunction only call transform when
+    their `fn` or `state` is first accessed, for example on the first call.
+    """
+
+    def __init__(self, fn, interact):
+        self.fn = fn
+        self.interact = interact
+        self.result = None
+        self.lock = threading.Lock()
+
+    def make(self):
+        if self.result is None:
+            with self.lock:
+                if self.result is None:
+                    self.result = transform(self.fn, interact=self.interact)
+        return self.result
+
+
 class BaseState:
-    __slots__ = ()
+    """State of a selfless function.
+
+    The values of the variables are stored in a list, in the order of the
+    class's ``__variables__``, and each variable is exposed as an attribute.
+    An unset variable holds ABSENT in the list and raises AttributeError
+    when accessed as an attribute. Interactions read the list directly at
+    the index of their Symbol.
+
+    ``_ptera_variant`` holds a value computed from the variables that are
+    set, such as the variant of the function to call, and it is reset to
+    None whenever a variable is set or deleted.
+    """
+
+    __slots__ = ("_ptera_values", "_ptera_variant")
+    __variables__ = ()
 
     def __init__(self, values):
+        self._ptera_values = [ABSENT] * len(self.__variables__)
+        self._ptera_variant = None
         for k, v in values.items():
             setattr(self, k, v)
 
+    def __copy__(self):
+        rval = object.__new__(type(self))
+        rval._ptera_values = self._ptera_values.copy()
+        rval._ptera_variant = self._ptera_variant
+        return rval
+
+
+def _state_property(name, index):
+    def fget(self):
+        value = self._ptera_values[index]
+        if value is ABSENT:
+            raise AttributeError(name)
+        return value
+
+    def fset(self, value):
+        self._ptera_values[index] = value
+        self._ptera_variant = None
+
+    def fdel(self):
+        self._ptera_values[index] = ABSENT
+        self._ptera_variant = None
+
+    return property(fget, fset, fdel)
+
 
 def state_class(fname, slots, vardoc, annotations):
+    slots = tuple(slots)
     for slot in slots:
         annotations.setdefault(slot, ABSENT)
     return type(
         f"{fname}.state",
         (BaseState,),
         {
-            "__slots__": tuple(slots),
+            "__slots__": (),
+            "__variables__": slots,
             "__vardoc__": vardoc,
             "__annotations__": annotations,
+            **{name: _state_property(name, i) for i, name in enumerate(slots)},
         },
     )
 
 
 class Selfless:
     def __init__(self, fn, state):
-        self.fn = fn
-        self._state = state
+        if isinstance(fn, PreFunction):
+            assert state is None
+            self._pre = fn
+        else:
+            self.fn = fn
+            self._state = state
+
+    def __getattr__(self, attr):
+        # fn and _state are only missing if the transform is pending
+        pre = self.__dict__.get("_pre", None)
+        if pre is None or attr not in ("fn", "_state"):
+            raise AttributeError(attr)
+        # Another thread may be doing the same, so fn and _state are both
+        # set before _pre is removed, and removing it again is harmless
+        self.fn, self._state = pre.make()
+        self.__dict__.pop("_pre", None)
+        return getattr(self, attr)
 
     @property
     def state(self):
@@ -356,16 +800,22 @@ class Selfless:
         return rval
 
     def clone(self, **kwargs):
-        kwargs = {"fn": self.fn, "state": copy(self.state), **kwargs}
+        kwargs = {"fn": self.fn, "state": self.state.__copy__(), **kwargs}
         return type(self)(**kwargs)
 
     def get(self, name):
-        return getattr(self.state, name, ABSENT)
+        slot = getattr(name, "slot", None)
+        if slot is None:
+            return getattr(self.state, name, ABSENT)
+        return self.state._ptera_values[slot]
 
-    def __call__(self, *args, **kwargs):
+    def _call_with(self, fn, args, kwargs):
         args = [override(arg, priority=0.5) for arg in args]
         kwargs = {k: override(arg, priority=0.5) for k, arg in kwargs.items()}
-        return self.fn(self, *args, **kwargs)
+        return fn(self, *args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        return self._call_with(self.fn, args, kwargs)
 
     def __str__(self):
         return f"{self.fn.__name__}"
@@ -406,8 +856,7 @@ def selfless_interact(sym, key, category, __self__, value):
 
 @keyword_decorator
 def selfless(fn, **defaults):
-    new_fn, state = transform(fn, interact=selfless_interact)
-    rval = Selfless(new_fn, state)
+    rval = Selfless(PreFunction(fn, interact=selfless_interact), None)
     if defaults:
         rval = rval.new(**defaults)
     return rval
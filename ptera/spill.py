@@ -0,0 +1,262 @@
+"""Collector that spills captured values to disk.
+
+Requires numpy. Values that are numbers or numpy arrays of a fixed shape and
+dtype are appended to a raw binary file per capture, which is read back as a
+`numpy.memmap`. Other values are appended to a pickle log.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+from array import array
+from urllib.parse import quote
+
+import numpy
+
+from .core import Collector, MapView, Tap
+from .selector import to_pattern
+from .utils import call_with_captures
+
+
+class ArrayColumn:
+    """Column of values of the same shape and dtype, stored in a raw file."""
+
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self.length = 0
+        self.file = open(path, "wb")
+
+    def accepts(self, value):
+        return value.shape == self.shape and value.dtype == self.dtype
+
+    def append(self, value):
+        self.file.write(numpy.ascontiguousarray(value).tobytes())
+        self.length += 1
+
+    def flush(self):
+        if not self.file.closed:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def read(self):
+        """Return the column as a read-only memmap, one row per match."""
+        self.flush()
+        if self.length == 0:
+            return numpy.empty((0, *self.shape), dtype=self.dtype)
+        return numpy.memmap(
+            self.path,
+            dtype=self.dtype,
+            mode="r",
+            shape=(self.length, *self.shape),
+        )
+
+
+class LogColumn:
+    """Column of arbitrary values, stored as a log of pickled lists.
+
+    The offset of each record is kept in memory so that records can be read
+    back in any order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array("q")
+        self.file = open(path, "wb")
+
+    def append(self, values):
+        self.offsets.append(self.file.tell())
+        pickle.dump(values, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def flush(self):
+        if not self.file.closed:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        self.flush()
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets[i])
+            return pickle.load(f)
+
+    def __iter__(self):
+        self.flush()
+        with open(self.path, "rb") as f:
+            for _ in range(len(self.offsets)):
+                yield pickle.load(f)
+
+
+def _as_array(values):
+    if len(values) != 1:
+        return None
+    (value,) = values
+    if isinstance(value, (numpy.ndarray, numpy.generic, int, float)):
+        value = numpy.asarray(value)
+        if not value.dtype.hasobject:
+            return value
+    return None
+
+
+def _single(values):
+    if len(values) != 1:
+        raise ValueError("Multiple values stored for capture")
+    return values[0]
+
+
+class SpillCollector(Collector):
+    """Collector that writes the captured values to files in a directory.
+
+    A capture's values go into an array file as long as each match has a
+    single value of the same shape and dtype, and into a pickle log
+    otherwise. `map` and `map_all` have the same interface as Collector's,
+    but `map("x")` returns a `numpy.memmap` when x is stored as an array.
+    Only the values are stored, so `map_full` is not supported.
+
+    Arguments:
+        pattern: The selector.
+        finalize: Function to call on this collector at the end of the call.
+        directory: The directory in which to create the collector's own
+            subdirectory for its files, so that collectors never share
+            files. If it is None, the system's temporary directory is used.
+            The subdirectory is deleted by `cleanup`.
+    """
+
+    def __init__(self, pattern, finalize=None, directory=None):
+        self.pattern = to_pattern(pattern)
+        self.finalizer = finalize
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix="ptera-", dir=directory)
+        self.length = 0
+        self.columns = {}
+
+        def listener(**kwargs):
+            for name, cap in kwargs.items():
+                self._append(name, cap.values)
+            self.length += 1
+
+        listener._ptera_argspec = None, set(self.pattern.all_captures())
+        self._listener = listener
+
+    def _path(self, name, ext):
+        return os.path.join(self.directory, f"{quote(name, safe='')}.{ext}")
+
+    def _append(self, name, values):
+        column = self.columns.get(name, None)
+        if column is None or isinstance(column, ArrayColumn):
+            arr = _as_array(values)
+            if column is None and arr is not None:
+                column = self.columns[name] = ArrayColumn(
+                    self._path(name, "bin"), arr.shape, arr.dtype
+                )
+            if arr is not None and column.accepts(arr):
+                column.append(arr)
+                return
+            column = self._to_log(name, column)
+        column.append(list(values))
+
+    def _to_log(self, name, column):
+        log = LogColumn(self._path(name, "pkl"))
+        if column is not None:
+            for row in column.read():
+                log.append([numpy.array(row) if column.shape else row])
+            column.close()
+            os.remove(column.path)
+        self.columns[name] = log
+        return log
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        raise TypeError("SpillCollector only stores values, use map()")
+
+    def column(self, name, multi=False):
+        """Return the values of the capture called name.
+
+        Arguments:
+            name: The name of the capture.
+            multi: If False, return one value per match, otherwise return
+                the list of values for each match.
+        """
+        column = self.columns.get(name, None)
+        if column is None:
+            return []
+        elif isinstance(column, ArrayColumn):
+            rows = column.read()
+            return rows[:, None] if multi else rows
+        elif multi:
+            return MapView(column, list)
+        else:
+            return MapView(column, _single)
+
+    def _map_columns(self, args, multi):
+        if args and isinstance(args[0], str):
+            assert all(isinstance(arg, str) for arg in args)
+            if len(args) == 1:
+                return self.column(args[0], multi)
+            names = args
+        else:
+            names = list(self.columns)
+        columns = [self.column(name, multi) for name in names]
+        rows = MapView(
+            range(self.length), lambda i: tuple(col[i] for col in columns)
+        )
+        if args and isinstance(args[0], str):
+            return rows
+        rows = MapView(rows, lambda row: dict(zip(names, row)))
+        if not args:
+            return rows
+        assert len(args) == 1
+        (fn,) = args
+        return MapView(rows, lambda entry: call_with_captures(fn, entry))
+
+    def map(self, *args):
+        return self._map_columns(args, multi=False)
+
+    def map_all(self, *args):
+        return self._map_columns(args, multi=True)
+
+    def map_full(self, *args):
+        raise TypeError("SpillCollector only stores values, use map()")
+
+    def close(self):
+        """Flush and close the files. The data can still be read."""
+        for column in self.columns.values():
+            column.close()
+
+    def cleanup(self):
+        """Close and delete the files and the collector's directory.
+
+        The data can no longer be read afterwards.
+        """
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.columns = {}
+        self.length = 0
+
+    def finalize(self):
+        self.close()
+        return super().finalize()
+
+
+class SpillTap(Tap):
+    """Tap that collects its results in a SpillCollector."""
+
+    def __init__(self, selector, finalize=None, directory=None):
+        super().__init__(selector, finalize)
+        self.directory = directory
+
+    def instantiate(self):
+        return SpillCollector(
+            self.selector, finalize=self.finalize, directory=self.directory
+        )
@@ -1,5 +1,7 @@
 import functools
+import threading
 from collections import defaultdict
+from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass, replace as dc_replace
 
 from .core import Capture, get_names
@@ -72,9 +74,9 @@ class Storage:
             key = tuple(
                 getattr(cap[k], field) for k, field in self._key_captures
             )
-            if key not in self.store:
-                self.store[key] = call_with_captures(fn, cap, full=role.full)
-            return self.store[key]
+            return self._get_or_init(
+                key, lambda: call_with_captures(fn, cap, full=role.full)
+            )
 
         wrapped._ptera_argspec = fn._ptera_argspec
         return wrapped
@@ -90,8 +92,7 @@ class Storage:
                 )
             except ValueError:
                 return
-            assert key in self.store
-            self.update_queue[key] = call_with_captures(fn, cap, full=role.full)
+            self._queue_update(key, call_with_captures(fn, cap, full=role.full))
 
         focus, names = fn._ptera_argspec
         wrapped._ptera_argspec = (
@@ -100,6 +101,19 @@ class Storage:
         )
         return wrapped
 
+    def _get_or_init(self, key, init):
+        if key not in self.store:
+            self.store[key] = init()
+        return self.store[key]
+
+    def _queue_update(self, key, value):
+        assert key in self.store
+        self.update_queue[key] = value
+
+    def _apply_updates(self):
+        for key, value in self.update_queue.items():
+            self.store[key] = value
+
     def _value_wrap(self, fn):
         @functools.wraps(fn)
         def wrapped(**cap):
@@ -156,6 +170,87 @@ class Storage:
         return self._rules
 
     def finalize(self):
-        for key, value in self.update_queue.items():
-            self.store[key] = value
+        self._apply_updates()
         return self
+
+
+class _Shard:
+    __slots__ = ("lock", "store", "update_queue", "key_locks")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store = {}
+        self.update_queue = {}
+        self.key_locks = {}
+
+
+class ConcurrentStorage(Storage):
+    """Storage that can be shared by calls running in several threads.
+
+    Keys are spread over shards that each have their own lock, so threads
+    working on different keys rarely contend. An initializer runs at most
+    once per key: it holds a lock for that key only, and other threads
+    asking for the same key wait for its result. Updates are queued per
+    shard and finalize applies the whole queue at once, holding every
+    shard's lock, so a reader never sees some updates of a batch and not
+    others.
+
+    `store` and `update_queue` are snapshots merged from the shards.
+    """
+
+    nshards = 16
+
+    def __init__(self):
+        self._shards = [_Shard() for _ in range(self.nshards)]
+        self._prepare()
+
+    def _shard(self, key):
+        return self._shards[hash(key) % self.nshards]
+
+    @property
+    def store(self):
+        with self._all_locks():
+            return {k: v for sh in self._shards for k, v in sh.store.items()}
+
+    @property
+    def update_queue(self):
+        with self._all_locks():
+            return {
+                k: v for sh in self._shards for k, v in sh.update_queue.items()
+            }
+
+    @contextmanager
+    def _all_locks(self):
+        with ExitStack() as stack:
+            for shard in self._shards:
+                stack.enter_context(shard.lock)
+            yield
+
+    def _get_or_init(self, key, init):
+        shard = self._shard(key)
+        # Fast path: dict lookups are atomic
+        value = shard.store.get(key, ABSENT)
+        if value is not ABSENT:
+            return value
+        with shard.lock:
+            key_lock = shard.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            value = shard.store.get(key, ABSENT)
+            if value is ABSENT:
+                value = init()
+                with shard.lock:
+                    shard.store[key] = value
+                    del shard.key_locks[key]
+        return value
+
+    def _queue_update(self, key, value):
+        shard = self._shard(key)
+        with shard.lock:
+            assert key in shard.store
+            shard.update_queue[key] = value
+
+    def _apply_updates(self):
+        with self._all_locks():
+            for shard in self._shards:
+                shard.store.update(shard.update_queue)
+                shard.update_queue.clear()
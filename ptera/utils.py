@@ -1,6 +1,7 @@
 import functools
 import inspect
 from contextlib import contextmanager
+from weakref import WeakKeyDictionary
 
 
 class Named:
@@ -23,6 +24,11 @@ class Named:
         """Return the object's name."""
         return self.name
 
+    def __reduce__(self):
+        # Named objects are module-level singletons, so they are pickled by
+        # reference
+        return self.name
+
 
 ABSENT = Named("ABSENT")
 # IMMEDIATE = Named("IMMEDIATE")
@@ -59,15 +65,52 @@ def keyword_decorator(deco):
     return new_deco
 
 
+def weak_cache(fn):
+    """Cache the result of a function of a single function argument.
+
+    The cache is weakly keyed by the function, or by the underlying function
+    for bound methods, since bound methods are created anew at each access.
+    Arguments that do not support weak references are not cached.
+    """
+    cache = WeakKeyDictionary()
+
+    @functools.wraps(fn)
+    def wrapped(arg):
+        key = getattr(arg, "__func__", arg)
+        try:
+            return cache[key]
+        except KeyError:
+            rval = cache[key] = fn(arg)
+            return rval
+        except TypeError:
+            return fn(arg)
+
+    return wrapped
+
+
+class ArgumentBinder:
+    """Select the keyword arguments that a function accepts."""
+
+    __slots__ = ("names", "varkw")
+
+    def __init__(self, fn):
+        spec = inspect.getfullargspec(fn)
+        self.names = frozenset(spec.args) | frozenset(spec.kwonlyargs)
+        self.varkw = spec.varkw is not None
+
+    def bind(self, captures):
+        if self.varkw:
+            return captures
+        else:
+            names = self.names
+            return {k: v for k, v in captures.items() if k in names}
+
+
+get_binder = weak_cache(ArgumentBinder)
+
+
 def call_with_captures(fn, captures, full=True):
-    args = inspect.getfullargspec(fn)
-    if args.varkw:
-        kwargs = captures
-    else:
-        kwargs = {}
-        for k, v in captures.items():
-            if k in args.args or k in args.kwonlyargs or args.varkw:
-                kwargs[k] = v
+    kwargs = get_binder(fn).bind(captures)
     if not full:
         kwargs = {k: v.value for k, v in kwargs.items()}
     return fn(**kwargs)
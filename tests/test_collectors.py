@@ -0,0 +1,283 @@
+import queue
+from array import array
+
+import pytest
+
+from ptera import cat, ptera
+from ptera.collectors import (
+    AggregateTap,
+    ColumnarTap,
+    ReservoirCollector,
+    RunningStats,
+    SampleTap,
+    SamplingCollector,
+    StreamTap,
+    StridedCollector,
+)
+from ptera.core import Tap
+
+
+@ptera
+def brie(x, y):
+    a: cat.Bouffe = x * x
+    b: cat.Bouffe = y * y
+    return a + b
+
+
+@ptera
+def double_brie(x1, y1):
+    a = brie[1](x1, x1 + 1)
+    b = brie[2](y1, y1 + 1)
+    return a + b
+
+
+def test_columnar_map():
+    _, coll = double_brie.using(ColumnarTap("brie{!a, b}"))(2, 10)
+    assert len(coll) == 2
+    assert coll.map("a") == array("q", [4, 100])
+    assert list(coll.map("b")) == [9, 121]
+    assert coll.map("a", "b") == [(4, 9), (100, 121)]
+    assert coll.map(lambda a, b: a + b) == [13, 221]
+    assert coll.map(lambda a: -a) == [-4, -100]
+    assert coll.map() == [{"a": 4, "b": 9}, {"a": 100, "b": 121}]
+    assert coll.map_all("a") == [[4], [100]]
+
+
+def test_columnar_mixed_types():
+    _, coll = double_brie.using(ColumnarTap("brie > x"))(2.5, 10)
+    assert coll.map("x") == [2.5, 10]
+
+
+def test_columnar_map_all():
+    _, coll = double_brie.using(ColumnarTap("double_brie{!x1} >> brie{x}"))(
+        2, 10
+    )
+    with pytest.raises(ValueError):
+        coll.map("x1", "x")
+    assert coll.map_all("x1", "x") == [([2], [2, 10])]
+
+
+def test_columnar_map_full():
+    _, coll = double_brie.using(ColumnarTap("brie > $param:Bouffe"))(2, 10)
+    assert coll.map("param") == array("q", [4, 9, 100, 121])
+    assert coll.map_full(lambda param: param.value) == [4, 9, 100, 121]
+    assert coll.map_full(lambda param: param.name) == ["a", "b", "a", "b"]
+    assert [cap.value for cap in coll.map_full("param")] == [4, 9, 100, 121]
+    assert coll.map_full()[1]["param"].name == "b"
+
+
+def test_columnar_finalize():
+    results = double_brie.using(
+        total=ColumnarTap("brie > a", lambda coll: sum(coll.map("a")))
+    )(2, 10)
+    assert results.total == 104
+
+
+@ptera
+def inner(i):
+    x = i * 2
+    return x
+
+
+@ptera
+def loop(n):
+    for i in range(n):
+        inner(i)
+
+
+def test_stream_function():
+    seen = []
+
+    def consume(x):
+        seen.append(x)
+
+    _, summary = loop.using(StreamTap("inner > x", consume))(4)
+    assert seen == [0, 2, 4, 6]
+    assert summary.count == 4
+
+
+def test_stream_queue():
+    q = queue.Queue(maxsize=10)
+    loop.using(StreamTap("inner{i, !x}", q))(3)
+    assert [q.get_nowait() for _ in range(3)] == [
+        {"i": 0, "x": 0},
+        {"i": 1, "x": 2},
+        {"i": 2, "x": 4},
+    ]
+    assert q.empty()
+
+
+def test_stream_generator():
+    totals = []
+
+    def consumer():
+        total = 0
+        try:
+            while True:
+                match = yield
+                total += match["x"]
+        finally:
+            totals.append(total)
+
+    fn = loop.using(StreamTap("inner > x", consumer))
+    fn(3)
+    fn(5)
+    assert totals == [6, 20]
+
+
+def test_stream_memory():
+    tap = StreamTap("inner > x", lambda x: None)
+    _, summary = loop.using(tap)(1000)
+    assert summary.count == 1000
+    assert not hasattr(summary, "data")
+
+
+def test_sample_every():
+    _, coll = loop.using(SampleTap("inner > x", every=3))(10)
+    assert coll.map("x") == [0, 6, 12, 18]
+
+
+def test_sample_accept():
+    calls = []
+
+    class Strided(StridedCollector):
+        def offer(self, index, captures):
+            calls.append(index)
+            super().offer(index, captures)
+
+    class StridedTap(Tap):
+        def instantiate(self):
+            return Strided(self.selector, 4)
+
+    _, coll = loop.using(StridedTap("inner > x"))(10)
+    assert coll.map("x") == [0, 8, 16]
+    assert coll.seen == 10
+    # Skipped matches never reach the listener
+    assert calls == [0, 4, 8]
+
+
+def test_sample_first_last():
+    _, coll = loop.using(SampleTap("inner > x", first=2))(10)
+    assert coll.map("x") == [0, 2]
+    _, coll = loop.using(SampleTap("inner > x", last=2))(10)
+    assert coll.map("x") == [16, 18]
+
+
+def test_sample_reservoir():
+    _, coll = loop.using(SampleTap("inner > x", reservoir=3, seed=1))(50)
+    xs = coll.map("x")
+    assert len(xs) == 3
+    assert xs == sorted(xs)
+    assert coll.indices == [x // 2 for x in xs]
+
+    _, coll = loop.using(SampleTap("inner > x", reservoir=30))(5)
+    assert coll.map("x") == [0, 2, 4, 6, 8]
+
+
+def test_reservoir_uniform():
+    counts = [0] * 20
+    for seed in range(2000):
+        coll = ReservoirCollector("x", 5, seed=seed)
+        for i in range(20):
+            if coll.accepts(i):
+                coll.offer(i, i)
+        coll.finalize()
+        for i in coll.data:
+            counts[i] += 1
+    # Each index is kept with probability 5/20
+    assert all(400 < count < 600 for count in counts)
+
+
+def test_sample_tap_options():
+    with pytest.raises(TypeError):
+        SampleTap("x")
+    with pytest.raises(TypeError):
+        SampleTap("x", first=1, last=1)
+    with pytest.raises(TypeError):
+        SamplingCollector("x")
+
+
+def test_aggregate_map():
+    fn = loop.using()
+
+    @fn.on(AggregateTap("inner > x"))
+    def x(x):
+        return x
+
+    with pytest.raises(TypeError, match="only keeps statistics"):
+        fn(3)
+
+
+def test_aggregate():
+    _, agg = loop.using(AggregateTap("inner{i, !x}", bins=(0, 10, 5)))(10)
+    assert agg.matches == 10
+    stats = agg["x"]
+    assert stats.count == 10
+    assert stats.mean == 9
+    assert stats.var == pytest.approx(33)
+    assert stats.min == 0
+    assert stats.max == 18
+    assert stats.histogram == [1, 1, 1, 1, 2]
+    assert stats.overflow == 4
+    assert stats.underflow == 0
+    assert agg["i"].mean == 4.5
+
+
+def test_aggregate_accumulated():
+    _, agg = double_brie.using(AggregateTap("double_brie{!x1} >> brie{x}"))(
+        2, 10
+    )
+    assert agg.matches == 1
+    assert agg["x"].count == 2
+    assert agg["x"].mean == 6
+
+
+def test_aggregate_finalize():
+    results = loop.using(m=AggregateTap("inner > x", lambda agg: agg["x"].max))(
+        10
+    )
+    assert results.m == 18
+
+
+def test_aggregate_arrays():
+    np = pytest.importorskip("numpy")
+    stats = RunningStats(bins=(0, 4, 4))
+    stats.add(np.array([1.0, 5.0]))
+    stats.add(np.array([3.0, -1.0]))
+    assert stats.mean.tolist() == [2.0, 2.0]
+    assert stats.var.tolist() == [1.0, 9.0]
+    assert stats.min.tolist() == [1.0, -1.0]
+    assert stats.max.tolist() == [3.0, 5.0]
+    assert stats.histogram == [0, 1, 0, 1]
+    assert stats.underflow == 1
+    assert stats.overflow == 1
+
+
+def test_running_stats_merge():
+    values = [3, 1, 4, 1, 5, 9, 2, 6]
+    whole = RunningStats(bins=(0, 10, 5))
+    parts = [RunningStats(bins=(0, 10, 5)) for _ in range(3)]
+    for i, v in enumerate(values):
+        whole.add(v)
+        parts[i % 2].add(v)
+    merged = parts[2].merge(parts[0]).merge(parts[1])
+    assert merged.count == whole.count
+    assert merged.mean == pytest.approx(whole.mean)
+    assert merged.var == pytest.approx(whole.var)
+    assert (merged.min, merged.max) == (1, 9)
+    assert merged.histogram == whole.histogram
+
+
+def test_pmap_columnar():
+    results = loop.using(ColumnarTap("inner{i, !x}")).pmap(
+        [2, 3], max_workers=2
+    )
+    assert results[1].map("i") == array("q", [0, 1, 0, 1, 2])
+    assert results[1].map("x") == array("q", [0, 2, 0, 2, 4])
+
+
+def test_pmap_aggregate():
+    results = loop.using(AggregateTap("inner > x")).pmap([2, 3], max_workers=2)
+    assert results[1].matches == 5
+    assert results[1]["x"].mean == pytest.approx(1.6)
+    assert results[1]["x"].max == 4
@@ -1,6 +1,29 @@
+import asyncio
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
-from ptera import Recurrence, cat, overlay, ptera, to_pattern
+from ptera import (
+    Recurrence,
+    cat,
+    overlay,
+    override,
+    ptera,
+    selector as sel,
+    to_pattern,
+)
+from ptera.core import (
+    Accumulator,
+    Capture,
+    PatternIndex,
+    Tap,
+    _collection_plan,
+    get_names,
+    merge_results,
+)
+from ptera.utils import ABSENT, call_with_captures
 
 from .common import one_test_per_assert
 
@@ -46,9 +69,9 @@ class GrabAll:
         self.rules = {pattern: {"listeners": listener}}
 
 
-def _test(f, args, pattern):
+def _test(f, args, pattern, compiled=False):
     store = GrabAll(pattern)
-    with overlay(store.rules):
+    with overlay(store.rules, compiled=compiled):
         f(*args)
     return store.results
 
@@ -117,6 +140,66 @@ def test_patterns():
     assert _dbrie("brie > x:float") == []
 
 
+def test_patterns_same_capture():
+    # When a capture name appears at two levels, the outer capture wins
+    assert _dbrie("double_brie{!a} > brie{a}") == [
+        {"a": [4, 100]},
+        {"a": [4, 100]},
+    ]
+    assert _test(rec, (1,), "rec{x} > rec{!x}") == [
+        {"x": [0]},
+        {"x": [1]},
+        {"x": [1]},
+    ]
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        "*{!x, y}",
+        "brie{!a}",
+        "a",
+        "double_brie >> a",
+        "double_brie{a} > brie{!x}",
+        "double_brie{extra{cheese}, brie{x}}",
+        "double_brie{extra{!cheese}, brie{x}}",
+        "brie[$i]{!a}",
+        "brie[2]{!a}",
+        "brie{!$v:Bouffe}",
+        "*{a} >> brie{!$v:Bouffe}",
+        "brie > x:int",
+    ],
+)
+def test_compiled_patterns(pattern):
+    expected = _dbrie(pattern)
+    for _ in range(2):
+        assert _test(double_brie, (2, 10), pattern, compiled=True) == expected
+
+
+@ptera
+def rec(n):
+    if n > 0:
+        rec(n - 1)
+    x = n
+    return x
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        "rec > rec > rec{!x}",
+        "rec{!n} > rec{n} > rec{x}",
+        "rec{n} >> rec{!x}",
+        "rec > rec{!x}",
+    ],
+)
+def test_compiled_patterns_recursive(pattern):
+    expected = _test(rec, (4,), pattern)
+    assert expected
+    for _ in range(2):
+        assert _test(rec, (4,), pattern, compiled=True) == expected
+
+
 @ptera
 def snapple(x):
     a = cabanana(x + 1)
@@ -139,6 +222,9 @@ def test_deep():
         {"y": [6], "z": [7]},
         {"y": [7], "z": [8]},
     ]
+    assert _test(
+        snapple, [5], "snapple > cabanana{y} > peacherry > z", compiled=True
+    ) == [{"y": [6], "z": [7]}, {"y": [7], "z": [8]}]
 
 
 @ptera
@@ -218,7 +304,7 @@ def test_tap_map():
 def test_tap_map_all():
     rval, acoll = double_brie.using("double_brie{!x1} >> brie{x}")(2, 10)
     with pytest.raises(ValueError):
-        acoll.map("x1", "x")
+        list(acoll.map("x1", "x"))
     assert acoll.map_all("x1", "x") == [([2], [2, 10])]
 
 
@@ -234,6 +320,22 @@ def test_tap_map_full():
     assert acoll.map_full(lambda param: param.name) == ["a", "b", "a", "b"]
 
 
+def test_tap_map_view():
+    rval, acoll = double_brie.using("brie{!a, b}")(2, 10)
+    view = acoll.map("a")
+    assert acoll.map("a") is view
+    assert len(view) == 2
+    assert view[1] == 100
+    assert view[-1] == 100
+    assert view[1:] == [100]
+    assert len(view[:1]) == 1
+    assert list(view) == [4, 100]
+    assert acoll.map()[0] == {"a": 4, "b": 9}
+    assert acoll.map_all("a", "b")[1] == ([100], [121])
+    acoll.data.append(acoll.data[0])
+    assert view == [4, 100, 4]
+
+
 def test_on():
     dbrie = double_brie.clone(return_object=True)
 
@@ -300,3 +402,388 @@ def test_readme():
 
     result = sumsquares.rewrite({"square{x} > rval": lambda x: x + 1})(3, 4)
     assert result == 9
+
+
+def test_fast_path():
+    # No active pattern: values are resolved directly against the state
+    assert square(3) == 9
+    assert square.new(x=override(2))(3) == 4
+    assert square.new(rval=override(7))(3) == 7
+    assert sumsquares.new(square=square.new(rval=override(1)))(3, 4) == 2
+    with pytest.raises(NameError):
+        mystery(10)
+
+
+def test_fast_path_nested():
+    # The tap only reaches sumsquares, square runs on the fast path
+    results = sumsquares.using(q="sumsquares > xx")(3, 4)
+    assert results.value == 25
+    assert results.q.map("xx") == [9]
+
+
+def test_variants():
+    variants = sumsquares.fn._ptera_variants
+    assert variants.optional == {"xx", "yy", "rval", "#value"}
+
+    results = sumsquares.using(q="sumsquares > xx")(3, 4)
+    assert results.value == 25
+    assert results.q.map("xx") == [9]
+    assert frozenset({"yy", "rval", "#value"}) in variants.cache
+
+    # Locals set in the state are still instrumented
+    assert sumsquares.new(yy=override(0))(3, 4) == 9
+
+
+def test_variants_cached():
+    fn = sumsquares.new()
+    assert fn(3, 4) == 25
+    assert fn.state._ptera_variant[1] is fn._variant(None)
+
+    # Setting a variable in the state invalidates the cached variant
+    fn.state.yy = override(0)
+    assert fn.state._ptera_variant is None
+    assert fn(3, 4) == 9
+    del fn.state.yy
+    assert fn(3, 4) == 25
+
+
+def test_pattern_index():
+    a, b, c, d = [
+        (to_pattern(sel), i)
+        for i, sel in enumerate(
+            ["brie > x", "extra > cheese", "*{x}", "brie > y"]
+        )
+    ]
+    index = PatternIndex([a, b, c])
+    assert index.candidates("brie") == [a, c]
+    assert index.candidates("extra") == [b, c]
+    assert index.candidates("cabanana") == [c]
+
+    index2 = index.extend([d])
+    assert index2.candidates("brie") == [a, c, d]
+    assert index2.entries == [a, b, c, d]
+    assert index.candidates("brie") == [a, c]
+    assert len(index) == 3
+    assert len(index2) == 4
+
+
+def test_collection_plan_cache():
+    assert _dbrie("brie{!a}") == [{"a": [4]}, {"a": [100]}]
+    hits = _collection_plan.cache_info().hits
+    assert _dbrie("brie{!a}") == [{"a": [4]}, {"a": [100]}]
+    assert _collection_plan.cache_info().hits == hits + 1
+
+
+def test_function_plan():
+    dbrie = double_brie.using(q="brie{!a, b}")
+    assert dbrie(2, 10).q.map("a") == [4, 100]
+    hits = _collection_plan.cache_info().hits
+    assert dbrie(2, 10).q.map("a") == [4, 100]
+    assert _collection_plan.cache_info().hits == hits + 1
+
+    # Clones share the plugins of the original
+    clone = dbrie.clone()
+    assert clone(2, 10).q.map("a") == [4, 100]
+    dbrie.use(r="brie > x")
+    for fn in (dbrie, clone):
+        results = fn(2, 10)
+        assert results.q.map("a") == [4, 100]
+        assert results.r.map("x") == [2, 10]
+
+
+def test_capture():
+    cap = Capture(sel.Element(name=None, capture="v"))
+    assert cap.empty()
+    assert cap.names == [] and cap.values == []
+    with pytest.raises(ValueError):
+        cap.value
+
+    cap.acquire("a", 1)
+    assert not cap.empty()
+    assert cap.name == "a" and cap.value == 1
+    assert cap.names == ["a"] and cap.values == [1]
+
+    cap.acquire("b", [2])
+    assert cap.names == ["a", "b"] and cap.values == [1, [2]]
+    with pytest.raises(ValueError):
+        cap.value
+
+    cap.add_name("c")
+    cap.pop_name()
+    assert cap.names == ["a", "b"]
+
+    cap2 = Capture(sel.Element(name=None, capture="v"))
+    cap2.add_name("d")
+    cap2.pop_name()
+    assert cap2.empty()
+    cap2.extend(cap)
+    assert cap2.names == ["a", "b"] and cap2.values == [1, [2]]
+
+
+def test_capture_snapshot():
+    cap = Capture(sel.Element(name=None, capture="v"))
+    assert cap.snapshot().empty()
+    cap.acquire("a", 1)
+    snap1 = cap.snapshot()
+    cap.acquire("b", 2)
+    snap2 = cap.snapshot()
+    cap.acquire("c", 3)
+    assert snap1.names == ["a"] and snap1.values == [1]
+    assert snap2.names == ["a", "b"] and snap2.values == [1, 2]
+    assert cap.values == [1, 2, 3]
+
+
+def test_accumulator_build():
+    ex, ey, ez = [sel.Element(name=name, capture=name) for name in "xyz"]
+    root = Accumulator(["x", "y", "z"], template=False)
+    root.varset(ex, "x", None, 1)
+    child = root.fork()
+    child.varset(ey, "y", None, 2)
+
+    env = child.build()
+    assert env.keys() == {"x", "y"}
+    assert child.build() is env
+
+    # Adding a value to a non-empty capture does not change the environment
+    root.varset(ex, "x", None, 3)
+    assert child.build() is env
+    assert env["x"].values == [1, 3]
+
+    root.varset(ez, "z", None, 4)
+    env2 = child.build()
+    assert env2 is not env
+    assert env2.keys() == {"x", "y", "z"}
+
+
+def test_get_names():
+    class Thing:
+        def f(self, a, b):
+            return a + b
+
+    names = get_names(Thing().f)
+    assert names == (None, {"a", "b"})
+    assert get_names(Thing().f) is names
+
+    def g(a, **kw):
+        return a, kw
+
+    assert get_names(g) == (None, {"a"})
+    g._ptera_argspec = ("a", {"a", "b"})
+    assert get_names(g) == ("a", {"a", "b"})
+
+    assert call_with_captures(Thing().f, {"a": 1, "b": 2, "c": 3}) == 3
+    assert call_with_captures(g, {"a": 1, "b": 2}) == (1, {"b": 2})
+
+
+@ptera
+async def aio_square(x):
+    await asyncio.sleep(0)
+    y = x * x
+    return y
+
+
+@ptera
+async def aio_sum(xs):
+    total = 0
+    for x in xs:
+        y = await aio_square(x)
+        total = total + y
+    return total
+
+
+def test_async():
+    assert asyncio.run(aio_sum([1, 2, 3])) == 14
+
+
+def test_async_tap():
+    async def main():
+        return await aio_sum.using("aio_square > y", "aio_sum > total")(
+            [1, 2, 3]
+        )
+
+    rval, ys, totals = asyncio.run(main())
+    assert rval == 14
+    assert ys.map("y") == [1, 4, 9]
+    assert totals.map("total") == [0, 1, 5, 14]
+
+
+def test_async_concurrent():
+    async def run(i):
+        xs = list(range(i))
+        rval, ys = await aio_sum.using("aio_square{x, !y}")(xs)
+        return rval, ys.map("x")
+
+    async def main():
+        return await asyncio.gather(*[run(i) for i in range(20)])
+
+    for i, (rval, xs) in enumerate(asyncio.run(main())):
+        assert rval == sum(x * x for x in range(i))
+        assert xs == list(range(i))
+
+
+def test_async_overlay():
+    results = []
+
+    async def main():
+        with overlay(
+            {"aio_square{!y}": {"listeners": lambda y: results.append(y.value)}}
+        ):
+            await aio_sum([2, 3])
+
+    asyncio.run(main())
+    assert results == [4, 9]
+
+
+@ptera
+def gen_square(x):
+    y = x * x
+    return y
+
+
+@ptera
+def gen_squares(n):
+    for i in range(n):
+        x = gen_square(i)
+        yield x
+    return n
+
+
+def test_generator():
+    assert list(gen_squares(4)) == [0, 1, 4, 9]
+
+
+def test_generator_streaming():
+    events = []
+    rules = {"gen_squares{!x}": {"listeners": lambda x: events.append(x.value)}}
+    with overlay(rules):
+        for value in gen_squares(3):
+            events.append(("got", value))
+    assert events == [0, ("got", 0), 1, ("got", 1), 4, ("got", 4)]
+
+
+def test_generator_tap():
+    gen = gen_squares.using("gen_square > y", "gen_squares > #yield")(3)
+    with pytest.raises(StopIteration) as exc:
+        while True:
+            next(gen)
+    rval, ys, yields = exc.value.value
+    assert rval == 3
+    assert ys.map("y") == [0, 1, 4]
+    assert yields.map("#yield") == [0, 1, 4]
+
+
+def test_generator_isolated():
+    gen = gen_squares.using("gen_square > y")(3)
+    assert next(gen) == 0
+    # The generator's frame and patterns are not active outside of it
+    assert gen_square(5) == 25
+    _, ys = brie.using("brie > a")(1, 2)
+    assert ys.map("a") == [1]
+    assert list(gen) == [1, 4]
+
+
+def test_generator_send_throw():
+    @ptera
+    def echo():
+        total = 0
+        while True:
+            try:
+                x = yield total
+                total = total + x
+            except ValueError:
+                total = 0
+
+    gen = echo.using(xs="echo > x", yields="echo > #yield")()
+    assert next(gen) == 0
+    assert gen.send(3) == 3
+    assert gen.send(4) == 7
+    assert gen.throw(ValueError) == 0
+    gen.close()
+
+
+def test_pickle_function():
+    fn = extra.new(cheese=10).using("extra > cheese")
+    fn2 = pickle.loads(pickle.dumps(fn))
+    assert fn2.fn is extra.fn
+    rval, coll = fn2()
+    assert rval == 11
+    assert coll.map("cheese") == [10]
+
+    with pytest.raises(pickle.PicklingError):
+        variant = brie.fn._ptera_variants.get(set())
+        pickle.dumps(brie.clone(fn=variant))
+
+
+def test_pickle_local_function():
+    @ptera
+    def local(x):
+        return x
+
+    with pytest.raises(pickle.PicklingError):
+        pickle.dumps(local)
+
+
+def test_pmap():
+    assert brie.pmap([1, 2], [3, 4], max_workers=2) == [10, 20]
+
+
+def test_pmap_merge():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = double_brie.using("brie{!a, b}").pmap(
+            [1, 2], [3, 4], executor=executor
+        )
+    assert results.value == [double_brie(1, 3), double_brie(2, 4)]
+    assert results[1].map("a") == [1, 9, 4, 16]
+
+
+def test_pmap_processes():
+    results = double_brie.using(bs="brie > b", q=Tap("brie > a")).pmap(
+        range(4), range(4), max_workers=2
+    )
+    assert results.value == [double_brie(i, i) for i in range(4)]
+    assert results.bs.map("b") == [
+        y for i in range(4) for y in [(i + 1) ** 2, (i + 1) ** 2]
+    ]
+    assert len(results.q.map("a")) == 8
+
+
+def test_merge_results():
+    assert merge_results([]) == []
+    assert merge_results([[1], [2, 3]]) == [1, 2, 3]
+    assert merge_results([1, 2]) == [1, 2]
+
+
+def test_lazy_transform():
+    @ptera
+    def lazy(x):
+        y = x + 1
+        return y
+
+    assert "fn" not in vars(lazy)
+    assert lazy(1) == 2
+    assert "fn" in vars(lazy)
+
+    @ptera
+    def lazy2(x):
+        y = x + 1
+        return y
+
+    assert lazy2.get("y") is ABSENT
+    assert "fn" in vars(lazy2)
+
+
+def test_lazy_transform_threads():
+    def lazy(x):
+        y = x + 1
+        return y
+
+    fns = [ptera(lazy) for _ in range(50)]
+    barrier = threading.Barrier(8)
+
+    def run(i):
+        barrier.wait()
+        return [fn(i) for fn in fns]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(run, range(8)))
+    assert results == [[i + 1] * 50 for i in range(8)]
@@ -0,0 +1,95 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ptera import ptera
+from ptera.collectors import SampleTap
+from ptera.core import Tap
+from ptera.dispatch import BackgroundTap, Dispatcher
+
+
+@ptera
+def square(x):
+    rval = x * x
+    return rval
+
+
+@ptera
+def squares(n):
+    acc = 0
+    for i in range(n):
+        acc += square(i)
+    return acc
+
+
+def test_background_tap():
+    rval, coll = squares.using(BackgroundTap("square > rval"))(10)
+    assert rval == 285
+    assert coll.map("rval") == [i * i for i in range(10)]
+
+
+def test_background_tap_thread():
+    threads = set()
+
+    def listener(rval):
+        threads.add(threading.current_thread())
+
+    class ListenerTap(Tap):
+        def instantiate(self):
+            coll = super().instantiate()
+            coll.rules = lambda: {coll.pattern: {"listeners": listener}}
+            return coll
+
+    tap = BackgroundTap(ListenerTap("square > rval"))
+    fn = squares.using(tap)
+    fn(3)
+    fn(3)
+    # The calls share the tap's worker thread
+    assert len(threads) == 1
+    assert threading.current_thread() not in threads
+    tap.close()
+    assert tap.executor is None
+
+
+def test_background_tap_finalize():
+    rval, total = squares.using(
+        BackgroundTap("square > rval").hook(lambda c: sum(c.map("rval")))
+    )(4)
+    assert rval == total == 14
+
+
+def test_background_tap_shared_executor():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tap = BackgroundTap("square > rval", executor=executor)
+        for _ in range(5):
+            _, coll = squares.using(tap)(50)
+            assert coll.map("rval") == [i * i for i in range(50)]
+
+
+def test_dispatcher_order():
+    results = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        dispatcher = Dispatcher(executor)
+        for i in range(100):
+            dispatcher.submit(lambda i: results.append(i), {"i": i})
+        dispatcher.flush()
+    assert results == list(range(100))
+
+
+def test_dispatcher_error():
+    def fail(x):
+        raise ValueError(x)
+
+    dispatcher = Dispatcher()
+    dispatcher.submit(fail, {"x": 1})
+    dispatcher.submit(fail, {"x": 2})
+    with pytest.raises(ValueError, match="1"):
+        dispatcher.close()
+
+
+def test_background_sample_tap():
+    rval, coll = squares.using(
+        BackgroundTap(SampleTap("square > rval", every=3))
+    )(10)
+    assert coll.map("rval") == [0, 9, 36, 81]
@@ -281,3 +281,8 @@ def test_specialize():
     assert sel.parse("co >> co >> $nut").specialize(
         {"nut": sel.Element(name="coconut", category="Fruit")}
     ) == sel.parse("co >> co >> (coconut as nut):Fruit")
+
+
+def test_parse_cache():
+    assert sel.parse("co >> co[$n] >> nut") is sel.parse("co >> co[$n] >> nut")
+    assert sel.to_pattern("co > $nut") is sel.to_pattern("co > $nut")
@@ -1,6 +1,18 @@
+import importlib.util
+import sys
+from copy import copy
+
 import pytest
 
-from ptera.selfless import ConflictError, Override, selfless
+import ptera.selfless
+from ptera.categories import cat
+from ptera.selfless import (
+    ConflictError,
+    Override,
+    SourceFile,
+    Symbol,
+    selfless,
+)
 
 from .common import one_test_per_assert
 
@@ -93,6 +105,20 @@ def test_state_set():
     assert puerh() == 5
 
 
+def test_state_copy():
+    state = puerh.new(x=4).state
+    clone = copy(state)
+    assert type(clone) is type(state)
+    clone.x = 10
+    assert (state.x, clone.x) == (4, 10)
+    assert clone.y == 3
+
+    del clone.y
+    with pytest.raises(AttributeError):
+        clone.y
+    assert state.y == 3
+
+
 def test_state_invalid_variables():
     puerh2 = puerh.new(x=4, y=5)
 
@@ -121,3 +147,122 @@ def test_override_arguments():
     with pytest.raises(ConflictError):
         chocolat.new(x=Override(2), y=3)(Override(4))
     assert chocolat.new(x=Override(2), y=3)(Override(4, priority=2)) == 49
+
+
+CACHED_MODULE = """
+from ptera.selfless import selfless
+
+@selfless
+def frappe(x, y=10):
+    # Amount of cream
+    cream: int
+    total = x + y + cream
+    return total
+"""
+
+
+def _import_file(path):
+    spec = importlib.util.spec_from_file_location(path.stem, str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_transform_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    monkeypatch.delenv("PTERA_CACHE", raising=False)
+    path = tmp_path / "cached.py"
+    path.write_text(CACHED_MODULE)
+
+    frappe = _import_file(path).frappe
+    assert frappe.new(cream=5)(1) == 16
+    assert len(list((tmp_path / "__pycache__" / "ptera").iterdir())) == 1
+
+    def fail(*args):
+        raise AssertionError("should be cached")
+
+    monkeypatch.setattr(ptera.selfless, "_analyze", fail)
+    monkeypatch.setattr(SourceFile, "_tokenize", fail)
+    monkeypatch.setattr(SourceFile, "_cache", {})
+    frappe = _import_file(path).frappe
+    assert frappe.new(cream=5)(1) == 16
+    assert frappe.state.__vardoc__ == {"cream": "Amount of cream"}
+    assert frappe.state.__annotations__["cream"] is int
+    assert frappe.new(cream=5, y=1)(1) == 7
+
+
+def test_transform_cache_edit(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    monkeypatch.delenv("PTERA_CACHE", raising=False)
+    path = tmp_path / "edited.py"
+    for i in range(3):
+        path.write_text(CACHED_MODULE.replace("x + y", f"x + y + {i * 100}"))
+        frappe = _import_file(path).frappe
+        assert frappe.new(cream=5)(1) == 16 + i * 100
+    # The entry of the edited function is replaced, not added to
+    assert len(list((tmp_path / "__pycache__" / "ptera").iterdir())) == 1
+
+
+def test_transform_cache_disabled(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    monkeypatch.setenv("PTERA_CACHE", "0")
+    path = tmp_path / "uncached.py"
+    path.write_text(CACHED_MODULE)
+    assert _import_file(path).frappe.new(cream=5)(1) == 16
+    assert not (tmp_path / "__pycache__" / "ptera").exists()
+
+
+def test_source_file():
+    source = SourceFile.get(__file__)
+    assert SourceFile.get(__file__) is source
+
+    def nested(x):
+        # The answer
+        y = x + 42
+        return y
+
+    src, comments, lineno = source.function(nested.__code__)
+    assert src.startswith("def nested(x):\n")
+    assert src.endswith("return y\n")
+    assert comments == {3: "The answer"}
+    assert lineno == nested.__code__.co_firstlineno
+
+    src, _, _ = source.function(chocolat.fn.__code__)
+    assert src.startswith("@selfless(add1=False)\ndef chocolat(x, y):")
+
+
+@selfless
+def fibonacci(n):
+    a: cat.Fib = n
+    if a < 2:
+        return a
+    return fibonacci(a - 1) + fibonacci(a - 2)
+
+
+def test_symbols():
+    seen = []
+
+    def interact(sym, key, category, __self__, value):
+        seen.append((sym, category))
+        return value
+
+    def square(x):
+        y: cat.Fib = x * x
+        return y
+
+    fn, state = ptera.selfless.transform(square, interact)
+    state = state.make()
+    assert fn(state, 3) == 9
+    seen = {sym: (sym, category) for sym, category in seen}
+    assert seen["y"] == ("y", cat.Fib)
+    x, y = seen["x"][0], seen["y"][0]
+    assert isinstance(x, Symbol)
+    assert hash(x) == hash("x")
+    assert y.slot == type(state).__variables__.index("y")
+
+
+def test_symbols_recursion():
+    assert fibonacci(10) == 55
+    original = fibonacci
+    assert fibonacci.new(fibonacci=lambda n: 1)(10) == 2
+    assert sys.modules[__name__].fibonacci is original
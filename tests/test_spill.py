@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+from ptera import ptera
+
+numpy = pytest.importorskip("numpy")
+
+from ptera.spill import SpillTap  # noqa: E402
+
+
+@ptera
+def layer(x):
+    act = numpy.full(3, x, dtype="float32")
+    return act
+
+
+@ptera
+def network(n):
+    for i in range(n):
+        layer(i)
+        info = {"i": i} if i % 2 else None
+    return info
+
+
+def test_spill_arrays(tmp_path):
+    _, coll = network.using(SpillTap("layer > act", directory=tmp_path))(4)
+    acts = coll.map("act")
+    assert isinstance(acts, numpy.memmap)
+    assert acts.shape == (4, 3)
+    assert acts[:, 0].tolist() == [0, 1, 2, 3]
+    assert coll.map_all("act").shape == (4, 1, 3)
+    assert len(coll) == 4
+    assert os.path.dirname(coll.directory) == str(tmp_path)
+    assert os.path.exists(os.path.join(coll.directory, "act.bin"))
+
+
+def test_spill_reuse_directory(tmp_path):
+    fn = network.using(SpillTap("layer > x", directory=tmp_path))
+    _, coll1 = fn(50)
+    xs = coll1.map("x")
+    _, coll2 = fn(3)
+    assert coll2.map("x").tolist() == [0, 1, 2]
+    # The second call does not touch the files of the first
+    assert numpy.asarray(xs)[49] == 49
+    assert coll1.directory != coll2.directory
+    coll1.cleanup()
+    coll2.cleanup()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_spill_cleanup():
+    _, coll = network.using(SpillTap("network > info"))(2)
+    assert os.path.isdir(coll.directory)
+    coll.cleanup()
+    assert not os.path.exists(coll.directory)
+    assert coll.map("info") == []
+
+
+def test_spill_scalars():
+    _, coll = network.using(SpillTap("layer{x, !act}"))(3)
+    assert coll.map("x").tolist() == [0, 1, 2]
+    assert coll.map("x", "act")[2][1].tolist() == [2, 2, 2]
+    assert coll.map(lambda x, act: x + act.sum()) == [0, 4, 8]
+    assert coll.map()[1]["x"] == 1
+
+
+def test_spill_log():
+    _, coll = network.using(SpillTap("network > info"))(4)
+    assert coll.map("info") == [None, {"i": 1}, None, {"i": 3}]
+    assert coll.map_all("info")[1] == [{"i": 1}]
+
+
+@ptera
+def mixed(values):
+    for v in values:
+        x = v
+    return x
+
+
+@ptera
+def mixed_loop():
+    for values in ([1], [2], [3.5], [4, 5]):
+        mixed(values)
+
+
+def test_spill_mixed():
+    _, coll = mixed_loop.using(SpillTap("mixed{!values, x}"))()
+    assert coll.map_all("x") == [[1], [2], [3.5], [4, 5]]
+    with pytest.raises(ValueError):
+        list(coll.map("x"))
+
+
+def test_spill_finalize():
+    tap = SpillTap("layer > x", lambda coll: coll.map("x").sum())
+    _, total = network.using(tap)(4)
+    assert total == 6
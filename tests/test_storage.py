@@ -1,5 +1,14 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from ptera import cat, ptera
-from ptera.storage import Storage, initializer, updater, valuer
+from ptera.storage import (
+    ConcurrentStorage,
+    Storage,
+    initializer,
+    updater,
+    valuer,
+)
 
 
 @ptera
@@ -148,3 +157,58 @@ def test_storage_updater_2():
 def test_direct_storage():
     mymul = mul.new(factor1=3, factor2=4)
     assert mymul(10) == 70
+
+
+def test_concurrent_storage_updater():
+    class UpdateStrategy(ConcurrentStorage):
+
+        pattern = "$f:Bouffe"
+        default_target = "f"
+
+        @initializer(target_name="factor1")
+        def init_factor1(self):
+            return 1
+
+        @initializer(target_name="factor2")
+        def init_factor2(self):
+            return 2
+
+        @updater
+        def update_factor(self, f):
+            return f + 1
+
+    strategy = UpdateStrategy()
+    g = grind.using(strategy)
+    res = g([10, 20])
+    assert res == 90
+    assert strategy.store == {("factor1",): 2, ("factor2",): 3}
+    assert strategy.update_queue == {}
+
+    res = g([10, 20])
+    assert res == 150
+
+
+def test_concurrent_storage_threads():
+    calls = []
+
+    class UpdateStrategy(ConcurrentStorage):
+
+        pattern = "$f:Bouffe"
+        default_target = "f"
+
+        @initializer(target_name="factor1")
+        def init_factor1(self):
+            calls.append("factor1")
+            time.sleep(0.01)
+            return 1
+
+        @initializer(target_name="factor2")
+        def init_factor2(self):
+            calls.append("factor2")
+            return 2
+
+    g = grind.using(UpdateStrategy())
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(g, [[10, 20]] * 32))
+    assert results == [90] * 32
+    assert sorted(calls) == ["factor1", "factor2"]